@@ -16,15 +16,39 @@ from ryu.lib.packet import packet, ethernet, ether_types, ipv4
 from ryu.topology import event
 from ryu.lib import hub
 
-from decimal import *
+import itertools
+import struct
 import time
 from collections import defaultdict
+import numpy as np
 
 from mab import *
+from paths import *
+from stats import *
 
 # Prefix Mac address for of the special MAC packet 
 # using to calculate link delay (theroritically presented in the paper)
-ETH_ADD_PREFIX = 'ff:ff:ff:ff:ff:'
+ETH_ADD_PREFIX = 'ff:ff:ff:'
+
+# Echo requests used to estimate controller-switch latency:
+ECHO_INTERVAL = 1 # seconds between two echo requests to a switch
+ECHO_WEIGHT = 0.2 # weight of a new RTT sample in the moving average
+
+# Seconds to wait for a statistics reply before the reading is dropped
+STATS_TIMEOUT = 1
+# Statistics of every switch are polled each STATS_INTERVAL seconds,
+# the last STATS_HISTORY samples are kept in memory
+STATS_INTERVAL = 1
+STATS_HISTORY = 600
+
+# Cookie of outbound traffic rules, followed by the ingress switch and a path generation number
+OUTBOUND_COOKIE_PREFIX = 0x1111 << 48
+OUTBOUND_COOKIE_MASK = 0xffffffffffffffff
+# After the ingress, outbound traffic is tagged with the VLAN ID OUTBOUND_VLAN | (generation & 1),
+# so the rules of a new path never replace those of the path in use on the switches they share
+OUTBOUND_VLAN = 0x100
+# Seconds to wait for the switches of a new outbound path to confirm its rules
+BARRIER_TIMEOUT = 1
 
 # Manually setup the egressnode set,
 # Need to change reponsding to each scenario:
@@ -37,77 +61,169 @@ OUTBOUND_SRC_IP = '11.0.0.1'
 OUTBOUND_DST_IP = '11.0.0.2'
 ##Note: Ip addresses of the virtual PC in the network is 10.0.0.x by default
 
+# Source IP of the outbound traffic entering at each ingress switch.
+# With MULTI_INGRESS = True, one bandit is run for every ingress switch listed here
+INGRESS_SRC_IPS = {INGRESS_NODE: OUTBOUND_SRC_IP}
+INGRESS_NODES = list(INGRESS_SRC_IPS)
+MULTI_INGRESS = False
+
+# Egress paths are all probed while the chosen one is measured, with SHADOW_PROBING = True
+# the rewards of the paths that were not chosen are fed to the MAB as side information
+# (their loss is the last one measured while they carried the traffic, 0 if they never did)
+SHADOW_PROBING = True
+
+# With LINK_TOMOGRAPHY = True, every link of the routing tree from the ingress to the egress
+# nodes is probed once per sample instead of every egress path, the delay of a path being
+# the sum of the delays of its links (each one compensated for the control channel)
+LINK_TOMOGRAPHY = True
+
+# Outbound traffic takes the cheapest path to its egress node, the cost of a link being the reward
+# its measured delay and loss cost. Links never probed cost as much as a delay of UNKNOWN_LINK_DELAY
+# (ms), and with LINK_TOMOGRAPHY the links of the K_PATHS cheapest paths to every egress node
+# are probed, so the alternatives of a path are measured before it is chosen
+K_PATHS = 3
+UNKNOWN_LINK_DELAY = 50
+
+# With LOAD_SPLITTING = True the outbound traffic is split over the SPLIT_EGRESS egress nodes
+# with the best mean reward, weighted by a softmax of their means (temperature SPLIT_TAU),
+# by a select group on the ingress switch. Packets are tagged with the VLAN ID
+# SPLIT_VLAN | index of their egress node in EGRESS_NODES so that the paths can share switches.
+# The paths follow the link weights and the topology like the single outbound path, which the
+# group rule (priority SPLIT_PRIORITY) replaces when the ingress starts splitting.
+# Switches choose the bucket of a packet from a hash of its flow, so the traffic is split
+# flow by flow: the weights only hold over many outbound flows
+LOAD_SPLITTING = False
+SPLIT_EGRESS = 3
+SPLIT_TAU = 1.0
+SPLIT_VLAN = 0x400
+SPLIT_PRIORITY = 65002
+SPLIT_COOKIE_PREFIX = 0x2222 << 48 # followed by the ingress, the egress node index and a path generation number
+
+# With FAST_FAILOVER = True the outbound path is backed by a link-disjoint path to the same
+# egress node, tagged with the VLAN ID FAILOVER_VLAN | egress. A fast failover group of the
+# ingress switch (ID FAILOVER_GROUP | ingress) moves the traffic to the backup path as soon
+# as the port of the primary path goes down; when a link further on the path goes down,
+# link_down leaves only the backup bucket in the group and reinstalls a new path
+FAST_FAILOVER = True
+FAILOVER_VLAN = 0x800
+FAILOVER_GROUP = 1 << 16
+FAILOVER_COOKIE_PREFIX = 0x3333 << 48 # followed by the ingress switch and a path generation number
+
+# MAB algorithm choosing the egress node (one of MAB_ALGORITHMS in mab.py) and its parameter,
+# a tuple for the algorithms taking several.
+# D_UCB (discount factor) and SW_UCB (window length) forget old rewards, so they recover
+# faster when the delay or loss of a link changes over time, both also take the exploration
+# factor xi and the range B of the rewards (about 11 with calculate_reward)
+# GaussianThompson takes the reward noise, BetaThompson the highest reward and LinUCB its
+# exploration factor, LinUCB learns the reward from the features of path_contexts
+MAB_ALGORITHM = 'SP_UCB2'
+MAB_PARAMS = {'egreedy': 0.1, 'softmax': 0.1, 'UCB1': None, 'SP_UCB2': 0.1, 'D_UCB': (0.9, 0.6, 11), 'SW_UCB': (50, 0.6, 11),
+              'GaussianThompson': 1.0, 'BetaThompson': 11, 'LinUCB': 1.0}
+
+# What the MAB learnt is saved in CHECKPOINT_FILE at most every CHECKPOINT_INTERVAL seconds,
+# a restarted controller restores it and only explores the egress nodes it did not know
+# (or whose path from the ingress changed)
+CHECKPOINT_FILE = 'mab-checkpoint.npz'
+CHECKPOINT_INTERVAL = 30
+# The checkpoint is restored once the ingress has a path to every egress node (the paths are
+# part of the arm fingerprints), or after PATHS_TIMEOUT seconds without the missing ones
+PATHS_TIMEOUT = 30
+
+# Capacity of the links (Mbit/s) turning the port rates into link utilization,
+# averaged over the last UTILIZATION_WINDOW seconds of port statistics
+LINK_CAPACITY = 100
+UTILIZATION_WINDOW = 5
+
+# Measurement of a decision stops once MIN_SAMPLES delay samples were taken and either the
+# confidence interval (CONFIDENCE_Z standard errors) of the reward is within REWARD_TOLERANCE
+# or the interval of one egress path lies above the intervals of all the others
+MIN_SAMPLES = 3
+REWARD_TOLERANCE = 0.25
+CONFIDENCE_Z = 1.96
+
 #Main app
 class enode_select(app_manager.RyuApp):
     OFP_VERSIONS = [ofproto_v1_3.OFP_VERSION]
 
     def __init__(self, *args, **kwargs):
         super(enode_select, self).__init__( *args, **kwargs)
-        self.monitor_thread = hub.spawn(self.monitor) # Spawn montior component (line #67)
-        self.selecting_thread = hub.spawn(self.selecting) # Spawn egress selection component (line #76)
+        self.selecting_thread = hub.spawn(self.selecting) # Spawn egress selection component
+        self.echo_thread = hub.spawn(self.echo_monitor) # Spawn controller-switch latency estimation
+        self.stats_thread = hub.spawn(self.stats_monitor) # Spawn statistics poller
 
         #Network toplology information:
         self.datapaths = {} #List of SDN switches's ID (or DATAPATH) in the network
         self.switches = [] #List of switch ENTITIES
         self.adjacency = defaultdict(dict) # self.adjacency[s1][s2] = port of switch s1 that links to switch s2
-        self.routing_table = defaultdict(dict) #self.routing_table[s1][s2] contains switchs in the shortest path from s1 to s2
-
-        self.current_egressnode = 0 # denotes current egress node
+        self.routing_table = RoutingTable(self.adjacency) #self.routing_table[s1][s2] contains switchs in the shortest path from s1 to s2, computed on demand and kept up to date by the topology handlers
+        self.link_weights = defaultdict(dict) # self.link_weights[s1][s2] = cost of the link from s1 to s2 from its measured delay and loss
+        self.delay_table = RoutingTable(self.adjacency, self.link_weights) # paths of the outbound traffic, weighted by self.link_weights
+
+        self.current_egressnode = {} # self.current_egressnode[ingress] = current egress node of the outbound traffic entering at ingress
+        self.outbound_rules = {} # self.outbound_rules[ingress] = (cookie, path) of the installed outbound rules
+        self.outbound_generation = defaultdict(int) # number of outbound paths installed per ingress, part of their cookie
+        self.split_paths = {} # self.split_paths[ingress][egress] = (cookie, path) of the outbound traffic split to egress
+        self.split_buckets = {} # self.split_buckets[ingress] = bucket weights {egress: weight} of its select group
+        self.backup_rules = {} # self.backup_rules[ingress] = (cookie, path) of the installed backup path rules
+        self.failover_groups = set() # IDs of the fast failover groups added to the ingress switches
+        self.reinstalling = set() # ingress switches whose outbound path is being replaced (link down or cheaper path)
+        self.mab_model = None # MAB model of the selecting thread, its arms follow the reachability of the egress nodes
 
         #For delay calculating
-        self.delay_start_time = defaultdict(dict) #sending time of the delay packet
-        self.delay_end_time = defaultdict(dict) # receiving time of the delay packet
-        self.delay_status = defaultdict(dict) # self.delay_status[s1][s2] = 0 - delay calculating ongoing in path s1-s2, 1 - calculating finished 
+        self.probe_seq = itertools.count(1) # sequence number carried in the payload of each delay packet
+        self.probes = {} # self.probes[seq] = path, deadline and measured delay of an in-flight delay packet
+        self.control_latency = {} # self.control_latency[dpid] = estimated one-way controller-switch latency (ms)
+        self.egress_delays = defaultdict(dict) # self.egress_delays[s1][s2] = latest mean delay of the path s1-s2
+        self.link_delays = {} # self.link_delays[(s1, s2)] = latest delay of the link from s1 to s2 (ms)
+        self.delay_paths = {} # self.delay_paths[(s1, s2)] = (topology version, path) of the installed delay packet rules
+        self.shadow_rewards = defaultdict(dict) # self.shadow_rewards[s1][s2] = reward of the path s1-s2 probed but not chosen in the last measurement from s1
 
         #For loss calculating
-        self.rx_flow_stats = defaultdict(dict) # flow_stats of s1-s2 at the beginning of the calculation
-        self.tx_flow_stats = defaultdict(dict) # flow_stats of s1-s2 at the end of calculation 
+        self.reply_waiters = {} # self.reply_waiters[(dpid, xid)] = event and body of a request waiting for its reply
+        self.path_loss = defaultdict(dict) # self.path_loss[s1][s2] = latest loss measured on the path s1-s2
 
-    # Monitor and update routing table
-    def monitor(self):
-        hub.sleep(2) #wait for connections
-        self.calculate_routing_table() #calculating routing table
+        #Statistics polled from every switch (read stats.py):
+        self.flow_stats = RingBuffer(STATS_HISTORY, ('packet_count', 'byte_count')) # keyed by (dpid, ipv4_src, ipv4_dst)
+        self.port_stats = RingBuffer(STATS_HISTORY, ('rx_packets', 'tx_packets', 'rx_bytes', 'tx_bytes',
+                                                     'rx_dropped', 'tx_dropped')) # keyed by (dpid, port_no)
+        self.aggregate_stats = RingBuffer(STATS_HISTORY, ('packet_count', 'byte_count', 'flow_count')) # keyed by dpid
 
-        # Periodically updating the routing table
-        while True:
-            hub.sleep(60)
-            self.calculate_routing_table()
-    
     # Main thread, choose egress node using pre-defined algorithm
     def selecting(self):
         hub.sleep(3) #Wait for connections
+        if MULTI_INGRESS:
+            return self.selecting_batch()
+        self.routing_table.warm_up([INGRESS_NODE]) #Only paths from the ingress node are computed
         # Import egress nodes into MAB actions
         action_list = [] # list of actions (read more in mab.py)
         for node in EGRESS_NODES:
             action_list.append(Action(node))
-        # Import a MAB algorithm. change SP_UCB2 to any of algorithms defined in mab.py
+        # Import a MAB algorithm. change MAB_ALGORITHM to any of algorithms defined in mab.py
         # Read mab.py for details of each algorithm
-        mab_model = SP_UCB2(action_list, len(action_list),0.1)
+        mab_model = self.create_mab(action_list)
+        self.mab_model = mab_model
+        self.wait_paths(INGRESS_NODE)
+        self.update_availability()
+        restored = load_checkpoint(CHECKPOINT_FILE, mab_model, *self.mab_fingerprints())
+        self.logger.info("RESTORED ARMS: " + str([action_list[i].id for i in restored]))
         self.logger.info(mab_model.actions)
+        self.checkpoint_time = time.monotonic()
         
         # Beginning phase, each egress node is chosen once
+        # (only the first one with shadow probing, the others are observed meanwhile)
         for i in range(len(action_list)):
+            if action_list[i].N > 0:
+                continue
+            mab_model.set_contexts(self.path_contexts(INGRESS_NODE))
             enode = action_list[i].id
-            self.change_egress_node(action_list[i].id)
-            tx1, rx1 = self.get_path_stats(INGRESS_NODE, enode)
+            if not self.change_egress_node(enode):
+                continue # the arm stays untried, the MAB model chooses it again later
             hub.sleep(3)
-
-            #delay calculating
-            delays = []
-            for j in range(10): #delay is calculated 10 times in a session
-                delay = self.calculate_link_delay(INGRESS_NODE, enode)
-                if delay != -1:
-                    delays.append(delay)
-                hub.sleep(1)
-            mean_delay = float(sum(delays) / len(delays))
-
-            tx2, rx2 = self.get_path_stats(INGRESS_NODE, enode)
-            loss = self.calculate_loss(tx1,rx1,tx2,rx2) #loss calculating
-            self.logger.info("DELAY: " + str(mean_delay))
-            self.logger.info("LOSS: " + str(loss))
-            reward = self.calculate_reward(loss, mean_delay)
-            self.logger.info(reward)
-            action_list[i].update(reward)
+            reward = self.measure_reward(INGRESS_NODE, enode, 10, 1) #delay is calculated 10 times in a session
+            if reward is not None:
+                action_list[i].update(reward)
+            self.observe_shadow(mab_model)
+            self.checkpoint_mab(mab_model)
 
         # Calculate and write results:
         with open('funet-light-reward.txt', 'a') as f:
@@ -122,31 +238,30 @@ class enode_select(app_manager.RyuApp):
 
             #Each round the mab_model is triggered to choose a egress points 20 times
             for timestep in range(20):
+                mab_model.set_contexts(self.path_contexts(INGRESS_NODE))
                 enode = mab_model.choose_action() #choose "new" egress node
                 dpid = enode.id
-                self.change_egress_node(dpid)
+                if LOAD_SPLITTING:
+                    self.split_outbound(self.split_weights(mab_model))
+                elif not self.change_egress_node(dpid):
+                    # the outbound traffic stayed on the current egress node, which gets the reward
+                    dpid = self.current_egressnode.get(INGRESS_NODE)
+                    if dpid is None:
+                        hub.sleep(2)
+                        continue
+                    enode = action_list[EGRESS_NODES.index(dpid)]
                 hub.sleep(2)
 
                 #Calculating statistics of the path:
-                tx1, rx1 = self.get_path_stats(INGRESS_NODE, dpid)
-                delays = []
-                for j in range(20):
-                    delay = self.calculate_link_delay(INGRESS_NODE, dpid)
-                    if delay != -1:
-                        delays.append(delay)
-                    hub.sleep(5)
-                mean_delay = float(sum(delays) / len(delays))
-                tx2, rx2 = self.get_path_stats(INGRESS_NODE, dpid)
-                loss = self.calculate_loss(tx1,rx1,tx2,rx2)
-                self.logger.info("LOSS: " + str(loss))
-                self.logger.info("DELAY: " + str(mean_delay))
-                reward = self.calculate_reward(loss, mean_delay)
-                enode.update(reward) #Update reward to the responding action
-                total_reward.append(reward)
-                self.logger.info("REWARD: " + str(reward))
+                reward = self.measure_reward(INGRESS_NODE, dpid, 20, 5)
+                if reward is not None:
+                    enode.update(reward) #Update reward to the responding action
+                    total_reward.append(reward)
+                self.observe_shadow(mab_model)
+                self.checkpoint_mab(mab_model)
 
             #mean reward of a round:
-            mean_reward = float(sum(total_reward) / len(total_reward))
+            mean_reward = float(sum(total_reward) / len(total_reward)) if total_reward else 0.0
             with open('funet-light-reward.txt', 'a') as f:
                 f.write(str(mean_reward) + '\n')
             self.logger.info("Loop finished in " + str(time.time() - time_start) +"s")
@@ -155,67 +270,548 @@ class enode_select(app_manager.RyuApp):
             if round == 13:
                 with open('funet-light-reward.txt', 'a') as f:
                     f.write(str(mab_model.actions) + '\n')
+                save_checkpoint(CHECKPOINT_FILE, mab_model, *self.mab_fingerprints())
                 break
+
+    # Wait until the links are discovered and ingress has a path to every egress node
+    def wait_paths(self, ingress):
+        deadline = time.monotonic() + PATHS_TIMEOUT
+        while not all(self.routing_table[ingress][enode] for enode in EGRESS_NODES):
+            if time.monotonic() >= deadline:
+                self.logger.info("!!!!WARNING: NO PATH TO SOME EGRESS NODES, THEIR ARMS ARE NOT RESTORED")
+                return
+            hub.sleep(1)
+
+    # Fingerprint of the setting the MAB learns in (algorithm and ingress node)
+    # and of each egress node (its path from the ingress node)
+    def mab_fingerprints(self):
+        fingerprint = MAB_ALGORITHM + ':' + str(INGRESS_NODE)
+        return fingerprint, ['-'.join(map(str, self.routing_table[INGRESS_NODE][enode])) for enode in EGRESS_NODES]
+
+    # Save the MAB model if the last checkpoint is older than CHECKPOINT_INTERVAL
+    def checkpoint_mab(self, mab_model):
+        if time.monotonic() - self.checkpoint_time < CHECKPOINT_INTERVAL:
+            return
+        save_checkpoint(CHECKPOINT_FILE, mab_model, *self.mab_fingerprints())
+        self.checkpoint_time = time.monotonic()
+
+    # MAB model of MAB_ALGORITHM over the actions
+    def create_mab(self, action_list):
+        param = MAB_PARAMS[MAB_ALGORITHM]
+        if param is None:
+            return MAB_ALGORITHMS[MAB_ALGORITHM](action_list, len(action_list))
+        if isinstance(param, tuple):
+            return MAB_ALGORITHMS[MAB_ALGORITHM](action_list, len(action_list), *param)
+        return MAB_ALGORITHMS[MAB_ALGORITHM](action_list, len(action_list), param)
+
+    # Controller mode with one bandit per ingress switch in INGRESS_NODES,
+    # all bandits choose and get rewarded at once
+    def selecting_batch(self):
+        ingress_nodes = INGRESS_NODES
+        self.routing_table.warm_up(ingress_nodes)
+        mab_model = BatchMAB(len(ingress_nodes), len(EGRESS_NODES), MAB_ALGORITHM, MAB_PARAMS[MAB_ALGORITHM])
+
+        # Beginning phase, each egress node is chosen once by every ingress
+        for i in range(len(EGRESS_NODES)):
+            if SHADOW_PROBING and i > 0:
+                break
+            arms, rewards = self.measure_rewards(ingress_nodes, np.full(len(ingress_nodes), i), 10, 1)
+            measured = ~np.isnan(rewards)
+            mab_model.update(arms[measured], rewards[measured], np.flatnonzero(measured))
+            self.observe_shadow_batch(mab_model, ingress_nodes)
+
+        round = 1
+        while True:
+            self.logger.info("*************************ROUND" + str(round) + "*****************")
+            time_start = time.time()
+            total_reward = []
+            for timestep in range(20):
+                arms, rewards = self.measure_rewards(ingress_nodes, mab_model.choose_actions(), 20, 5)
+                measured = ~np.isnan(rewards)
+                mab_model.update(arms[measured], rewards[measured], np.flatnonzero(measured))
+                self.observe_shadow_batch(mab_model, ingress_nodes)
+                total_reward.append(rewards)
+            mean_rewards = np.nanmean(total_reward, axis=0)
+            for ingress, mean_reward in zip(ingress_nodes, mean_rewards):
+                self.logger.info("INGRESS " + str(ingress) + " MEAN REWARD: " + str(mean_reward))
+            self.logger.info("Loop finished in " + str(time.time() - time_start) +"s")
+            round += 1
+            # Stop after 12 rounds
+            if round == 13:
+                self.logger.info(mab_model.mean)
+                break
+
+    # Move every ingress to the egress node of its chosen arm and measure all paths
+    # at the same time, returns the arms actually measured and their rewards in the order
+    # of ingress_nodes. An ingress that could not move keeps being measured on its current
+    # egress node, its reward is NaN if it has none or if no probe of its path came back
+    def measure_rewards(self, ingress_nodes, arms, samples, interval):
+        arms = np.array(arms)
+        for k, ingress in enumerate(ingress_nodes):
+            if not self.change_egress_node(EGRESS_NODES[arms[k]], ingress):
+                current = self.current_egressnode.get(ingress)
+                arms[k] = EGRESS_NODES.index(current) if current is not None else -1
+        hub.sleep(2)
+        threads = [hub.spawn(self.measure_reward, ingress, EGRESS_NODES[arm], samples, interval) if arm >= 0 else None
+                   for ingress, arm in zip(ingress_nodes, arms)]
+        rewards = [thread.wait() if thread is not None else None for thread in threads]
+        return arms, np.array([reward if reward is not None else np.nan for reward in rewards])
+
+    # Measure delay (at most samples times, interval seconds apart) and loss of the path
+    # from src to dst, returns the reward (None if every probe of the path was lost)
+    # Every egress path is probed along with the chosen one, at no extra wall time
+    def measure_reward(self, src, dst, samples, interval):
+        start_time = time.monotonic()
+        delays = defaultdict(list) # delays[enode] = delay samples of the path src-enode
+        probe = self.probe_tree if LINK_TOMOGRAPHY else self.probe_paths
+        for j in range(samples):
+            for enode, delay in probe(src, EGRESS_NODES).items():
+                if delay != -1:
+                    delays[enode].append(delay)
+            if self.enough_samples(src, dst, delays, j + 1, start_time):
+                break
+            hub.sleep(interval)
+        self.logger.info("SAMPLES: " + str(j + 1) + " IN " + str(time.monotonic() - start_time) + "s")
+        for enode in EGRESS_NODES:
+            if delays[enode]:
+                self.egress_delays[src][enode] = float(sum(delays[enode]) / len(delays[enode]))
+        self.logger.info("EGRESS DELAYS: " + str(self.egress_delays[src]))
+        self.update_link_weights(start_time, time.monotonic())
+        self.refresh_outbound(src)
+        # the paths not chosen are only rewarded when their loss was measured in the same window,
+        # an unknown loss would count as none and favour the arms that were never chosen
+        self.shadow_rewards[src] = {}
+        for enode in EGRESS_NODES:
+            if enode == dst or not delays[enode]:
+                continue
+            shadow_loss = self.path_window_loss(src, enode, start_time, time.monotonic())
+            if shadow_loss is not None:
+                self.path_loss[src][enode] = shadow_loss
+                self.shadow_rewards[src][enode] = self.calculate_reward(shadow_loss, self.egress_delays[src][enode])
+        if not delays[dst]:
+            self.logger.info("!!!!WARNING: NO DELAY SAMPLE OF THE PATH, NO REWARD")
+            return None
+        mean_delay = float(sum(delays[dst]) / len(delays[dst]))
+        loss = self.path_window_loss(src, dst, start_time, time.monotonic())
+        if loss is None:
+            # not enough polled samples in the window, fall back to the last loss measured on this path
+            loss = self.path_loss[src].get(dst, 0)
+            self.logger.info("!!!!WARNING: MISSING FLOW STATS, USING LAST LOSS")
+        self.path_loss[src][dst] = loss
+        self.logger.info("THROUGHPUT: " + str(self.window_throughput(src, dst, start_time, time.monotonic())))
+        self.logger.info("LOSS: " + str(loss))
+        self.logger.info("DELAY: " + str(mean_delay))
+        reward = self.calculate_reward(loss, mean_delay)
+        self.logger.info("REWARD: " + str(reward))
+        return reward
     
+    # Mean reward of the delay samples of a path and half width of its confidence interval
+    def reward_interval(self, loss, delays):
+        if not delays:
+            return 0, np.inf
+        rewards = np.array([self.calculate_reward(loss, delay) for delay in delays])
+        if len(rewards) < 2:
+            return rewards[0], np.inf
+        return rewards.mean(), CONFIDENCE_Z * rewards.std(ddof=1) / np.sqrt(len(rewards))
+
+    # Whether the n samples taken since t0 settle the measurement of the path src-dst,
+    # loss of each path is measured since t0 too, or the last one measured on it (none if it
+    # never was, an upper bound of its reward that only delays the decision)
+    def enough_samples(self, src, dst, delays, n, t0):
+        if n < MIN_SAMPLES:
+            return False
+        now = time.monotonic()
+        intervals = {}
+        for enode in EGRESS_NODES:
+            loss = self.path_window_loss(src, enode, t0, now)
+            if loss is None:
+                loss = self.path_loss[src].get(enode, 0)
+            intervals[enode] = self.reward_interval(loss, delays[enode])
+        if intervals[dst][1] <= REWARD_TOLERANCE:
+            return True
+        best = max(intervals, key=lambda enode: intervals[enode][0])
+        lower = intervals[best][0] - intervals[best][1]
+        return all(lower > mean + width for enode, (mean, width) in intervals.items() if enode != best)
+
+    # Utilization of the busiest link of the path src-dst, from the tx bytes of its ports
+    def path_utilization(self, src, dst):
+        path = self.egress_path(src, dst)
+        now = time.monotonic()
+        tx_bytes = self.port_stats.field('tx_bytes')
+        utilization = 0
+        for s1, s2 in zip(path, path[1:]):
+            times, values = self.port_stats.window((s1, self.routing_table.out_port(s1, s2)), now - UTILIZATION_WINDOW, now)
+            if len(times) < 2 or times[-1] == times[0]:
+                continue
+            rate = (values[-1, tx_bytes] - values[0, tx_bytes]) * 8 / (times[-1] - times[0])
+            utilization = max(utilization, rate / (LINK_CAPACITY * 1e6))
+        return utilization
+
+    # Features of the path from src to every egress node, for contextual MAB algorithms:
+    # a bias, its last mean delay (in 100 ms), last loss, hop count (in 10 hops)
+    # and the utilization of its busiest link
+    def path_contexts(self, src):
+        return np.array([[1,
+                          self.egress_delays[src].get(enode, 0) / 100.0,
+                          self.path_loss[src].get(enode, 0),
+                          (len(self.egress_path(src, enode)) - 1) / 10.0,
+                          self.path_utilization(src, enode)]
+                         for enode in EGRESS_NODES])
+
+    # Feed the rewards of the egress paths probed but not chosen in the last measurement
+    # from INGRESS_NODE to mab_model, without pulling their arms
+    def observe_shadow(self, mab_model):
+        if not SHADOW_PROBING:
+            return
+        for enode, reward in self.shadow_rewards[INGRESS_NODE].items():
+            mab_model.observe(EGRESS_NODES.index(enode), reward)
+        self.shadow_rewards[INGRESS_NODE] = {}
+
+    # Same for every bandit of a BatchMAB, in the order of ingress_nodes
+    def observe_shadow_batch(self, mab_model, ingress_nodes):
+        if not SHADOW_PROBING:
+            return
+        instances, arms, rewards = [], [], []
+        for k, ingress in enumerate(ingress_nodes):
+            for enode, reward in self.shadow_rewards[ingress].items():
+                instances.append(k)
+                arms.append(EGRESS_NODES.index(enode))
+                rewards.append(reward)
+            self.shadow_rewards[ingress] = {}
+        if instances:
+            mab_model.observe(arms, rewards, instances)
+
     #triggered when a new egress_node is chosen (new path for the outbound traffic):
-    def change_egress_node(self, new_enode_dpid):
+    # make-before-break, the new path is committed on every switch before the old rules are removed.
+    # Returns True if the outbound traffic of ingress leaves through the new egress node
+    def change_egress_node(self, new_enode_dpid, ingress=INGRESS_NODE):
         self.logger.info("******** Change egressnode to switch: dpid: " + str(new_enode_dpid))
-        if new_enode_dpid == self.current_egressnode:
-            return
-        if self.current_egressnode != 0:
-            self.delete_path(INGRESS_NODE,self.current_egressnode) #delete old path for the outbound traffic
-        hub.sleep(0.5)
-        self.current_egressnode = new_enode_dpid
-        self.install_path(INGRESS_NODE, new_enode_dpid) # install new path
+        current_enode = self.current_egressnode.get(ingress, 0)
+        if new_enode_dpid == current_enode:
+            return True
+        start_time = time.time()
+        old_rules = self.outbound_rules.get(ingress)
+        if not self.install_path(ingress, new_enode_dpid): # install new path
+            self.logger.info("!!!!WARNING: EGRESS NODE NOT CHANGED, TRAFFIC STAYS ON: " + str(current_enode))
+            return False
+        if old_rules is not None:
+            self.delete_path(ingress, old_rules) #delete what is left of the old path for the outbound traffic
+        self.current_egressnode[ingress] = new_enode_dpid
+        self.logger.info("Egress switched in " + str(time.time() - start_time) + "s")
+        return True
     
-    # Install external path from src switch to dst switch
+    # Install external path from src switch to dst switch, tagged with a new cookie.
+    # The rules after the ingress match the VLAN ID of the new generation, which differs from
+    # the one of the path in use: they are added and confirmed with barriers while the traffic
+    # stays on the old path, and the ingress rule tagging the traffic moves it at once.
+    # Returns True when all switches confirmed
     def install_path(self, src, dst):
-        if src != INGRESS_NODE or dst not in EGRESS_NODES:
+        if src not in INGRESS_SRC_IPS or dst not in EGRESS_NODES:
             self.logger.info("!!!!WARNING: NOT RIGHT PATH INSTALL FUNCTION")
+            return False
+        path = self.outbound_path(src, dst)
+        if not path:
+            return False
+        old_rules = self.outbound_rules.get(src)
+        self.outbound_generation[src] += 1
+        if old_rules is not None and (self.outbound_generation[src] ^ old_rules[0]) & 1 == 0:
+            self.outbound_generation[src] += 1 # the tag of the path in use
+        cookie = OUTBOUND_COOKIE_PREFIX | (src << 24) | (self.outbound_generation[src] & 0xffffff)
+        vid = OUTBOUND_VLAN | (self.outbound_generation[src] & 1) if len(path) > 1 else None
+
+        if vid is not None:
+            self.install_tagged_path(src, path, vid, cookie)
+        if not self.barrier(path[1:]):
+            self.logger.info("!!!!WARNING: NEW PATH NOT CONFIRMED, INGRESS NOT SWITCHED")
+            self.delete_path(src, (cookie, path))
+            return False
+        old_backup = self.backup_rules.pop(src, None)
+        group = self.install_backup(src, path, vid) if FAST_FAILOVER and vid is not None else None
+        port = self.delay_table.out_port(path[0], path[1]) if vid is not None else 1
+        self.add_outbound_flow(path[0], port, src, cookie, group, vid) # outbound traffic moves to the new path here
+        self.barrier(path[:1])
+        if old_backup is not None:
+            self.delete_path(src, old_backup)
+        self.outbound_rules[src] = (cookie, path)
+        return True
+
+    # Install a path link-disjoint from path to the same egress node, tagged for the failover,
+    # and point the fast failover group of the ingress switch at both paths.
+    # Returns the group ID, None if there is no backup path
+    def install_backup(self, src, path, vid):
+        dst = path[-1]
+        banned = set(zip(path[:-1], path[1:])) | set(zip(path[1:], path[:-1]))
+        pred, _ = shortest_path_tree(self.adjacency, src, self.link_weights, self.delay_table.index, banned)
+        backup = tree_path(pred, src, dst)
+        if not backup:
+            self.logger.info("!!!!WARNING: NO BACKUP PATH TO THE EGRESS NODE")
+            return None
+        cookie = FAILOVER_COOKIE_PREFIX | (src << 24) | (self.outbound_generation[src] & 0xffffff)
+        self.install_tagged_path(src, backup, FAILOVER_VLAN | dst, cookie)
+        if not self.barrier(backup[1:]):
+            self.logger.info("!!!!WARNING: BACKUP PATH NOT CONFIRMED")
+            self.delete_path(src, (cookie, backup))
+            return None
+        self.backup_rules[src] = (cookie, backup)
+        self.logger.info("BACKUP PATH: " + str(backup))
+        self.failover_group(src, path, backup, vid)
+        return FAILOVER_GROUP | src
+
+    # Fast failover group of the ingress switch: the primary path (tagged with vid) while the port
+    # it leaves by is live, else the backup path (the only one if primary is None)
+    def failover_group(self, src, primary, backup, vid=None):
+        dp = self.datapaths[src]
+        ofp = dp.ofproto
+        ofp_parser = dp.ofproto_parser
+        buckets = []
+        if primary is not None:
+            port = self.delay_table.out_port(primary[0], primary[1])
+            actions = [ofp_parser.OFPActionPushVlan(0x8100),
+                       ofp_parser.OFPActionSetField(vlan_vid=(ofp.OFPVID_PRESENT | vid)),
+                       ofp_parser.OFPActionOutput(port)]
+            buckets.append(ofp_parser.OFPBucket(0, port, ofp.OFPG_ANY, actions))
+        port = self.delay_table.out_port(backup[0], backup[1])
+        actions = [ofp_parser.OFPActionPushVlan(0x8100),
+                   ofp_parser.OFPActionSetField(vlan_vid=(ofp.OFPVID_PRESENT | FAILOVER_VLAN | backup[-1])),
+                   ofp_parser.OFPActionOutput(port)]
+        buckets.append(ofp_parser.OFPBucket(0, port, ofp.OFPG_ANY, actions))
+        group = FAILOVER_GROUP | src
+        command = ofp.OFPGC_MODIFY if group in self.failover_groups else ofp.OFPGC_ADD
+        dp.send_msg(ofp_parser.OFPGroupMod(dp, command, ofp.OFPGT_FF, group, buckets))
+        self.failover_groups.add(group)
+
+    # Event hook for a link that went down: outbound traffic whose path used it is moved to its
+    # backup path at once and a new path is installed, egress nodes that cannot be reached
+    # anymore are marked unavailable and the traffic leaves them for the best available one
+    def link_down(self, s1, s2):
+        start_time = time.monotonic()
+        for ingress, (cookie, path) in list(self.outbound_rules.items()):
+            links = set(zip(path[:-1], path[1:]))
+            if (s1, s2) not in links and (s2, s1) not in links:
+                continue
+            backup = self.backup_rules.get(ingress)
+            if backup is not None and not set([(s1, s2), (s2, s1)]) & set(zip(backup[1][:-1], backup[1][1:])):
+                self.failover_group(ingress, None, backup[1])
+                self.logger.info("Failed over to the backup path in " + str((time.monotonic() - start_time) * 1000) + "ms")
+            if ingress not in self.reinstalling:
+                self.reinstalling.add(ingress)
+                hub.spawn(self.reinstall_outbound, ingress)
+        for ingress, rules in list(self.split_paths.items()):
+            links = set(link for cookie, path in rules.values() for link in zip(path[:-1], path[1:]))
+            if ((s1, s2) in links or (s2, s1) in links) and ingress not in self.reinstalling:
+                self.reinstalling.add(ingress)
+                hub.spawn(self.reinstall_outbound, ingress)
+        self.update_availability()
+
+    # Install a new path to the current egress node of ingress, or to the best available one
+    # if it cannot be reached anymore. An ingress splitting its traffic gets new paths to the
+    # egress nodes of its buckets instead
+    def reinstall_outbound(self, ingress):
+        enode = self.current_egressnode.get(ingress)
+        old_rules = self.outbound_rules.get(ingress)
+        if ingress in self.split_paths:
+            self.split_outbound(self.split_buckets[ingress], ingress)
+        elif enode is not None and self.delay_table[ingress][enode]:
+            if self.install_path(ingress, enode) and old_rules is not None:
+                self.delete_path(ingress, old_rules)
+        elif enode is not None and self.mab_model is not None and ingress == INGRESS_NODE:
+            best = self.mab_model.actions[self.mab_model.best(self.mab_model.state.mean)].id
+            self.logger.info("!!!!WARNING: EGRESS NODE " + str(enode) + " UNREACHABLE")
+            self.change_egress_node(best, ingress)
+        self.reinstalling.discard(ingress)
+
+    # Move the outbound traffic of ingress to a cheaper path to its egress node, when the
+    # link weights changed since its path was installed (an ingress splitting its traffic keeps its paths)
+    def refresh_outbound(self, ingress):
+        installed = self.outbound_rules.get(ingress)
+        if installed is None or ingress in self.split_paths or ingress in self.reinstalling:
+            return
+        paths = self.delay_table.k_shortest_paths(ingress, installed[1][-1], K_PATHS)
+        if not paths or path_cost(paths[0], self.link_weights) >= path_cost(installed[1], self.link_weights):
             return
-        path = self.routing_table[src][dst]
-        ports = [] #outport for each switch in the path
-        for s1, s2 in zip(path[:-1], path[1:]):
-            ports.append(self.adjacency[s1][s2])
-        ports.append(1)
+        self.logger.info("CHEAPER OUTBOUND PATH: " + str(paths[0]))
+        self.reinstalling.add(ingress)
+        self.reinstall_outbound(ingress)
 
-        for i in range(len(path)):
-            switch = path[i]
-            out_port = ports[i]
+    # Mark the arms of the egress nodes that INGRESS_NODE cannot reach as unavailable
+    def update_availability(self):
+        if self.mab_model is None:
+            return
+        for i in range(self.mab_model.action_num):
+            self.mab_model.set_available(i, bool(self.delay_table[INGRESS_NODE][self.mab_model.actions[i].id]))
 
-            dp = self.datapaths[switch]
+    # Cheapest of the K_PATHS shortest paths from src to dst, [] if there is none
+    def outbound_path(self, src, dst):
+        paths = self.delay_table.k_shortest_paths(src, dst, K_PATHS)
+        if not paths:
+            self.logger.info("!!!!WARNING: NO PATH TO THE EGRESS NODE")
+            return []
+        self.logger.info("OUTBOUND PATHS: " + str([(path, path_cost(path, self.link_weights)) for path in paths]))
+        return paths[0]
+
+    # Path the outbound traffic from src takes to the egress node dst: the installed one if
+    # dst is the current egress node, else the one it would be moved to
+    def egress_path(self, src, dst):
+        installed = self.outbound_rules.get(src)
+        if installed is not None and installed[1][-1] == dst:
+            return installed[1]
+        split = self.split_paths.get(src, {}).get(dst)
+        if split is not None:
+            return split[1]
+        return self.delay_table[src][dst]
+
+    # Bucket weights {egress node: weight} of the SPLIT_EGRESS egress nodes with the best mean reward
+    def split_weights(self, mab_model):
+        mean = mab_model.state.mean
+        top = np.argsort(-mean)[:SPLIT_EGRESS]
+        p = np.exp((mean[top] - mean[top].max()) / SPLIT_TAU)
+        weights = np.maximum(1, np.round(100 * p / p.sum())).astype(int)
+        return dict((mab_model.actions[i].id, int(w)) for i, w in zip(top, weights))
+
+    # Split the outbound traffic entering at ingress over the egress nodes of weights with the
+    # select group of the ingress switch (group ID = ingress). The paths to the egress nodes are
+    # recomputed each time, new or changed ones are installed and confirmed first, then the buckets
+    # are replaced in place and the rules of the old paths are deleted. The first time, the group
+    # rule takes over from the single outbound path, which is deleted with its backup.
+    # Returns True when the group was updated
+    def split_outbound(self, weights, ingress=INGRESS_NODE):
+        self.logger.info("******** Split outbound traffic: " + str(weights))
+        old_rules = self.split_paths.get(ingress, {})
+        rules = {}
+        for enode in weights:
+            path = self.outbound_path(ingress, enode)
+            if not path:
+                continue
+            if enode in old_rules and old_rules[enode][1] == path:
+                rules[enode] = old_rules[enode]
+                continue
+            index = EGRESS_NODES.index(enode)
+            self.outbound_generation[ingress] += 1
+            cookie = SPLIT_COOKIE_PREFIX | (ingress << 24) | (index << 14) | (self.outbound_generation[ingress] % 0x3fff + 1)
+            self.install_tagged_path(ingress, path, SPLIT_VLAN | index, cookie)
+            rules[enode] = (cookie, path)
+        if not rules:
+            self.logger.info("!!!!WARNING: NO PATH TO THE SPLIT EGRESS NODES, BUCKETS NOT UPDATED")
+            return False
+        new = [enode for enode in rules if rules[enode] != old_rules.get(enode)]
+        if not self.barrier(set(switch for enode in new for switch in rules[enode][1][1:])):
+            self.logger.info("!!!!WARNING: NEW PATHS NOT CONFIRMED, BUCKETS NOT UPDATED")
+            return False
+
+        dp = self.datapaths[ingress]
+        ofp = dp.ofproto
+        ofp_parser = dp.ofproto_parser
+        buckets = []
+        for enode, (cookie, path) in rules.items():
+            port = self.delay_table.out_port(path[0], path[1])
+            actions = [ofp_parser.OFPActionPushVlan(0x8100),
+                       ofp_parser.OFPActionSetField(vlan_vid=(ofp.OFPVID_PRESENT | SPLIT_VLAN | EGRESS_NODES.index(enode))),
+                       ofp_parser.OFPActionOutput(port)]
+            buckets.append(ofp_parser.OFPBucket(weights[enode], port, ofp.OFPG_ANY, actions))
+        command = ofp.OFPGC_MODIFY if ingress in self.split_paths else ofp.OFPGC_ADD
+        dp.send_msg(ofp_parser.OFPGroupMod(dp, command, ofp.OFPGT_SELECT, ingress, buckets))
+        if ingress not in self.split_paths:
+            match_ip = ofp_parser.OFPMatch(eth_type=0x0800, ipv4_src=INGRESS_SRC_IPS[ingress], ipv4_dst=OUTBOUND_DST_IP)
+            self.add_flow(dp, SPLIT_PRIORITY, match_ip, [ofp_parser.OFPActionGroup(ingress)], SPLIT_COOKIE_PREFIX | (ingress << 24))
+        self.barrier([ingress])
+
+        if ingress not in self.split_paths:
+            for single in (self.outbound_rules.pop(ingress, None), self.backup_rules.pop(ingress, None)):
+                if single is not None:
+                    self.delete_path(ingress, single)
+            self.current_egressnode.pop(ingress, None)
+        for enode, old in old_rules.items():
+            if rules.get(enode) != old:
+                self.delete_path(ingress, old)
+        self.split_paths[ingress] = rules
+        self.split_buckets[ingress] = weights
+        return True
+
+    # Forward the outbound traffic entering at ingress and tagged with the VLAN ID vid along
+    # path (but its first switch, where a group tags it), the egress switch removes the tag
+    def install_tagged_path(self, ingress, path, vid, cookie):
+        for i in reversed(range(1, len(path))):
+            dp = self.datapaths[path[i]]
             ofp = dp.ofproto
             ofp_parser = dp.ofproto_parser
-
             match_ip = ofp_parser.OFPMatch(
                 eth_type=0x0800,
-                ipv4_src = OUTBOUND_SRC_IP,
+                vlan_vid=(ofp.OFPVID_PRESENT | vid),
+                ipv4_src = INGRESS_SRC_IPS[ingress],
                 ipv4_dst = OUTBOUND_DST_IP
             )
+            if i == len(path) - 1:
+                action = [ofp_parser.OFPActionPopVlan(), ofp_parser.OFPActionOutput(1)]
+            else:
+                action = [ofp_parser.OFPActionOutput(self.delay_table.out_port(path[i], path[i + 1]))]
+            self.add_flow(dp, 65001, match_ip, action, cookie)
+
+    # Forward the outbound traffic entering at ingress to out_port of switch, tagged with vid
+    # if given, or to a group
+    def add_outbound_flow(self, switch, out_port, ingress, cookie, group=None, vid=None):
+        dp = self.datapaths[switch]
+        ofp_parser = dp.ofproto_parser
+
+        match_ip = ofp_parser.OFPMatch(
+            eth_type=0x0800,
+            ipv4_src = INGRESS_SRC_IPS[ingress],
+            ipv4_dst = OUTBOUND_DST_IP
+        )
 
+        if group is not None:
+            action = [ofp_parser.OFPActionGroup(group)]
+        elif vid is not None:
+            action = [ofp_parser.OFPActionPushVlan(0x8100),
+                      ofp_parser.OFPActionSetField(vlan_vid=(dp.ofproto.OFPVID_PRESENT | vid)),
+                      ofp_parser.OFPActionOutput(out_port)]
+        else:
             action = [ofp_parser.OFPActionOutput(out_port)]
-            self.add_flow(dp, 65000, match_ip, action)
-
-    # Delete an old path (when changing egress node)
-    def delete_path(self, src, dst):
-        if src != INGRESS_NODE or dst not in EGRESS_NODES:
-            self.logger.info("!!!!WARNING: NOT RIGHT PATH DELETE FUNCTION")
-            return
-        old_path = self.routing_table[src][dst]
-        for i in range(len(old_path)):
-            switch = old_path[i]
-
+        self.add_flow(dp, 65000, match_ip, action, cookie)
+
+    # Delete an old path (when changing egress node): rules of the switches shared with
+    # the new path were already replaced, only the ones still carrying the old cookie go
+    def delete_path(self, src, old_rules):
+        cookie, old_path = old_rules
+        for switch in old_path:
+            if switch not in self.datapaths:
+                continue
             dp = self.datapaths[switch]
-            ofp = dp.ofproto
             ofp_parser = dp.ofproto_parser
+            self.delete_flow(dp, ofp_parser.OFPMatch(), cookie, OUTBOUND_COOKIE_MASK)
 
-            match_ip = ofp_parser.OFPMatch(
-                eth_type=0x0800,
-                ipv4_src = OUTBOUND_SRC_IP,
-                ipv4_dst = OUTBOUND_DST_IP
-            )
-
-            self.delete_flow(dp, match_ip)
+    # Send a barrier to every switch and wait until all of them processed the previous messages,
+    # returns False if one did not answer within BARRIER_TIMEOUT
+    def barrier(self, switches):
+        waiters = []
+        for switch in switches:
+            dp = self.datapaths[switch]
+            waiters.append(self.send_request(dp, dp.ofproto_parser.OFPBarrierRequest(dp)))
+        deadline = time.monotonic() + BARRIER_TIMEOUT
+        confirmed = True
+        for waiter in waiters:
+            if self.wait_reply(waiter, max(0, deadline - time.monotonic())) is None:
+                confirmed = False
+        return confirmed
+
+    # Loss of the link from s1 to s2 between t0 and t1 from the port counters of both ends,
+    # None if the window holds less than two samples of a counter
+    def link_loss(self, s1, s2, t0, t1):
+        _, tx = self.port_stats.window((s1, self.routing_table.out_port(s1, s2)), t0, t1)
+        _, rx = self.port_stats.window((s2, self.routing_table.out_port(s2, s1)), t0, t1)
+        if len(tx) < 2 or len(rx) < 2:
+            return None
+        tx_packets = self.port_stats.field('tx_packets')
+        rx_packets = self.port_stats.field('rx_packets')
+        return self.calculate_loss(tx[0, tx_packets], rx[0, rx_packets], tx[-1, tx_packets], rx[-1, rx_packets])
+
+    # Cost of the probed links for the outbound paths: the reward lost to their last
+    # delay and to their loss between t0 and t1
+    def update_link_weights(self, t0, t1):
+        for (s1, s2), delay in self.link_delays.items():
+            if s1 not in self.routing_table or s2 not in self.routing_table:
+                continue
+            loss = self.link_loss(s1, s2, t0, t1) or 0
+            self.delay_table.set_link_weight(s1, s2, float(self.calculate_reward(0, 0) - self.calculate_reward(loss, delay)))
 
     # Reward function
     def calculate_reward(self, loss, delay):
@@ -223,135 +819,229 @@ class enode_select(app_manager.RyuApp):
         beta = 25
         return 11 - alpha * loss - beta * delay / 100
     
-    # Get flow statistics of a path
-    def get_path_stats(self, src, dst):
-        dp_src = self.datapaths[src]
-        parser = dp_src.ofproto_parser
-
-        match = parser.OFPMatch(
-            eth_type=0x0800,
-            ipv4_src = '10.0.0.' + str(src),
-            ipv4_dst = '10.0.0.' + str(dst)
-        )
-
-        self.request_stats(src,match)
-        self.request_stats(dst,match)
-        hub.sleep(1.5)
-        tx = self.tx_flow_stats[src][dst]
-        rx = self.rx_flow_stats[src][dst]
-        return tx, rx
-
-    # Loss calculating function
+    # Flow stats keys of the outbound traffic entering at src, as sent by src and as received by the egress node dst
+    def path_flow_keys(self, src, dst):
+        ip_src = INGRESS_SRC_IPS[src]
+        return (src, ip_src, OUTBOUND_DST_IP), (dst, ip_src, OUTBOUND_DST_IP)
+
+    # Loss of the path src-dst between t0 and t1 (monotonic time) from the polled flow stats,
+    # None if the window holds less than two samples of a counter
+    def window_loss(self, src, dst, t0, t1):
+        tx_key, rx_key = self.path_flow_keys(src, dst)
+        _, tx = self.flow_stats.window(tx_key, t0, t1)
+        _, rx = self.flow_stats.window(rx_key, t0, t1)
+        if len(tx) < 2 or len(rx) < 2:
+            return None
+        packets = self.flow_stats.field('packet_count')
+        return self.calculate_loss(tx[0, packets], rx[0, packets], tx[-1, packets], rx[-1, packets])
+
+    # Loss of the path src-dst between t0 and t1, from the flow stats of the outbound traffic
+    # if dst is its egress node, else from the port stats of its links. None if either lacks samples
+    def path_window_loss(self, src, dst, t0, t1):
+        if self.current_egressnode.get(src) == dst:
+            loss = self.window_loss(src, dst, t0, t1)
+            if loss is not None:
+                return loss
+        path = self.egress_path(src, dst)
+        if not path:
+            return None
+        link_losses = [self.link_loss(s1, s2, t0, t1) for s1, s2 in zip(path, path[1:])]
+        if None in link_losses:
+            return None
+        return 1 - float(np.prod([1 - loss for loss in link_losses]))
+
+    # Throughput (bytes/s) sent by src to dst between t0 and t1, None if not enough samples
+    def window_throughput(self, src, dst, t0, t1):
+        times, tx = self.flow_stats.window(self.path_flow_keys(src, dst)[0], t0, t1)
+        if len(times) < 2 or times[-1] == times[0]:
+            return None
+        sent = tx[-1, self.flow_stats.field('byte_count')] - tx[0, self.flow_stats.field('byte_count')]
+        return sent / (times[-1] - times[0])
+
+    # Loss calculating function, None if one of the counters is missing
     def calculate_loss(self, tx1, rx1, tx2, rx2):
+        if None in (tx1, rx1, tx2, rx2):
+            return None
         tx_diff = tx2 - tx1
         rx_diff = rx2 - rx1
         loss = (1.0 - float(rx_diff) / tx_diff) if tx_diff > 0 else 0
         return max(0,loss)
 
-    # Calculate delay between switch src to switch dst (theriotically reported in the paper)
-    def calculate_link_delay(self, src, dst):
-        eth_src = ETH_ADD_PREFIX + str(src)
-        eth_dst = ETH_ADD_PREFIX + str(dst)
-        pkt = DelayPacket.delay_packet(eth_src,eth_dst) #craft delay-calculating packet
-        self.install_delay_path(src, dst) #install path for the delay-calculating packet
-        self.delay_status[src][dst] = 0 
-        path = self.routing_table[src][dst] #get path from src to dst
-        out_port = self.adjacency[src][path[1]] #get the out port for the packet
+    # Probe the paths from switch src to every switch in dsts at the same time,
+    # returns delays[dst] in ms, -1 for the case when the delay packet is lost
+    def probe_paths(self, src, dsts, timeout=1):
+        paths = dict((dst, self.egress_path(src, dst)) for dst in dsts)
+        #install paths for the delay-calculating packets, only new or changed paths send flow mods
+        if any([self.install_delay_path(src, dst, paths[dst]) for dst in dsts if paths[dst]]):
+            hub.sleep(0.5)
+        seqs = [self.send_probe(src, dst, timeout, paths[dst]) if paths[dst] else None for dst in dsts]
+        delays = {}
+        for dst, seq in zip(dsts, seqs):
+            delays[dst] = self.wait_probe(seq) if seq is not None else -1
+        return delays
+
+    # Links of the outbound paths (paths[dst]) from src to every egress node in dsts and of their
+    # K_PATHS cheapest alternatives, those shared by several paths once
+    def tree_links(self, src, dsts, paths):
+        links = []
+        for dst in dsts:
+            for path in [paths[dst]] + self.delay_table.k_shortest_paths(src, dst, K_PATHS):
+                links.extend(link for link in zip(path[:-1], path[1:]) if link not in links)
+        return links
+
+    # Probe every link of the outbound paths from src to the egress nodes in dsts (and of their
+    # alternatives) once, at the same time, returns delays[dst] in ms (the sum of the link delays
+    # of its outbound path when the probes were sent), -1 if a delay packet of the path is lost
+    def probe_tree(self, src, dsts, timeout=1):
+        # the outbound paths can change while waiting for the probes
+        paths = dict((dst, self.egress_path(src, dst)) for dst in dsts)
+        links = self.tree_links(src, dsts, paths)
+        if any([self.install_delay_path(s1, s2, [s1, s2]) for s1, s2 in links]):
+            hub.sleep(0.5)
+        seqs = [self.send_probe(s1, s2, timeout, [s1, s2]) for s1, s2 in links]
+        samples = {}
+        for link, seq in zip(links, seqs):
+            samples[link] = self.wait_probe(seq)
+            if samples[link] != -1:
+                self.link_delays[link] = samples[link]
+        delays = {}
+        for dst in dsts:
+            path = paths[dst]
+            link_delays = [samples.get(link, -1) for link in zip(path[:-1], path[1:])]
+            delays[dst] = -1 if -1 in link_delays or not path else sum(link_delays)
+        return delays
+
+    # Send a delay packet from src to dst without waiting for it, returns its sequence number
+    # (along the routing path by default)
+    def send_probe(self, src, dst, timeout, path=None):
+        seq = next(self.probe_seq)
+        eth_src = DelayPacket.eth_addr(src)
+        eth_dst = DelayPacket.eth_addr(dst)
+        if path is None:
+            path = self.routing_table[src][dst] #get path from src to dst
+        out_port = self.routing_table.out_port(src, path[1]) #get the out port for the packet
 
         dp = self.datapaths[src]
         ofproto = dp.ofproto
         parser = dp.ofproto_parser
 
+        send_time = time.monotonic_ns()
+        pkt = DelayPacket.delay_packet(eth_src, eth_dst, seq, send_time) #craft delay-calculating packet
         action = [parser.OFPActionOutput(out_port)]
         msg = parser.OFPPacketOut(
             datapath=dp, in_port=ofproto.OFPP_CONTROLLER,
             buffer_id=ofproto.OFP_NO_BUFFER,actions = action, data=pkt
         )
-        hub.sleep(0.5)
-        self.delay_start_time[src][dst] = Decimal(time.time())
+        self.probes[seq] = {
+            'src': src,
+            'dst': dst,
+            'delay': None,
+            'deadline': send_time + int(timeout * 1e9),
+            'event': hub.Event(),
+            'handler': self.probe_reply
+        }
         dp.send_msg(msg) #send delay packet
-        hub.sleep(1)
-
-        #for the case when the delay packet is lost in transferring
-        if not self.delay_status[src][dst]:
-            self.delay_status[src][dst] = 1
+        return seq
+
+    # Wait for the delay packet seq until its own deadline, returns its delay in ms (-1 if lost)
+    def wait_probe(self, seq):
+        probe = self.probes[seq]
+        probe['event'].wait(timeout=max(0, (probe['deadline'] - time.monotonic_ns()) / 1e9))
+        del self.probes[seq]
+        if probe['delay'] is None:
             return -1
+        return probe['delay']
 
-        delay = self.delay_end_time[src][dst] - self.delay_start_time[src][dst]
-        self.delete_delay_path(src, dst)
-        return delay * 1000
-
-    # Install delay packet forwarding in a specific path    
-    def install_delay_path(self, src, dst):
-        path = self.routing_table[src][dst]        
-        ports = [] #outport for each switch in the path
-        for s1, s2 in zip(path[:-1], path[1:]):
-            ports.append(self.adjacency[s1][s2])
-        ports.append(1)
-
-        if len(path) > 2 :
-            for i in range(1, len(path) - 1):
-                switch = path[i]
-                out_port = ports[i]
+    # One-way delay in ms of the path src-dst from the time a delay packet spent between
+    # its packet out and its packet in, without the control channel share of both switches
+    def compensate_delay(self, src, dst, elapsed_ns):
+        delay = elapsed_ns / 1e6 - self.control_latency.get(src, 0) - self.control_latency.get(dst, 0)
+        return max(0.0, delay)
 
-                dp = self.datapaths[switch]
-                ofp = dp.ofproto
-                ofp_parser = dp.ofproto_parser
-                if dst < 10: #For virtual machine # 1-9
-                    match = ofp_parser.OFPMatch(
-                        eth_type = DelayPacket.DELAY_ETH_TYPE, 
-                        eth_src = ETH_ADD_PREFIX + '0' + str(src), 
-                        eth_dst = ETH_ADD_PREFIX + '0' + str(dst)
-                    )
-                else: #For virtual machine # 10-99
-                    match = ofp_parser.OFPMatch(
-                        eth_type = DelayPacket.DELAY_ETH_TYPE, 
-                        eth_src = ETH_ADD_PREFIX + str(src), 
-                        eth_dst = ETH_ADD_PREFIX + str(dst)
-                    )
-
-                action = [ofp_parser.OFPActionOutput(out_port)]
-                self.add_flow(dp, 1, match, action)
-                self.add_flow(dp, 1, match, action)
-
-        delay_dst_sw = self.datapaths[dst]
-        ofp = delay_dst_sw.ofproto
-        ofp_parser = delay_dst_sw.ofproto_parser
-        match = ofp_parser.OFPMatch(
-            eth_type = DelayPacket.DELAY_ETH_TYPE, 
-            eth_src = ETH_ADD_PREFIX + str(src), 
-            eth_dst = ETH_ADD_PREFIX + str(dst)
-        )
-        actions = [ofp_parser.OFPActionOutput(ofp.OFPP_CONTROLLER)]
-        self.add_flow(delay_dst_sw, 1, match, actions)
+    # Periodically send echo requests carrying their sending time to every switch
+    def echo_monitor(self):
+        while True:
+            for dp in list(self.datapaths.values()):
+                parser = dp.ofproto_parser
+                data = struct.pack('!Q', time.monotonic_ns())
+                dp.send_msg(parser.OFPEchoRequest(dp, data=data))
+            hub.sleep(ECHO_INTERVAL)
+
+    # Update the controller-switch latency estimate (half of the echo RTT, in ms)
+    @set_ev_cls(ofp_event.EventOFPEchoReply, MAIN_DISPATCHER)
+    def echo_reply_handler(self, ev):
+        rx_time = time.monotonic_ns()
+        data = ev.msg.data
+        if len(data) != 8:
+            return
+        latency = (rx_time - struct.unpack('!Q', data)[0]) / 2e6
+        dpid = ev.msg.datapath.id
+        if dpid in self.control_latency:
+            latency = (1 - ECHO_WEIGHT) * self.control_latency[dpid] + ECHO_WEIGHT * latency
+        self.control_latency[dpid] = latency
+
+    # Install delay packet forwarding in a specific path (the routing path by default), once per path:
+    # the rules stay on the switches and are only replaced when the path changes.
+    # Returns True if flow mods were sent
+    def install_delay_path(self, src, dst, path=None):
+        version = self.routing_table.version
+        installed = self.delay_paths.get((src, dst))
+        if installed is not None and installed[0] == version and (path is None or installed[1] == path):
+            return False
+        if path is None:
+            path = self.routing_table[src][dst]
+        if installed is not None:
+            if installed[1] == path:
+                self.delay_paths[(src, dst)] = (version, path)
+                return False
+            self.delete_delay_path(src, dst)
+
+        ports = [self.routing_table.out_port(s1, s2) for s1, s2 in zip(path[:-1], path[1:])] #outport for each switch in the path
+        cookie = DelayPacket.cookie(src, dst)
+        for i in range(1, len(path)):
+            switch = path[i]
+            dp = self.datapaths[switch]
+            ofp = dp.ofproto
+            ofp_parser = dp.ofproto_parser
+            match = ofp_parser.OFPMatch(
+                eth_type = DelayPacket.DELAY_ETH_TYPE, 
+                eth_src = DelayPacket.eth_addr(src), 
+                eth_dst = DelayPacket.eth_addr(dst)
+            )
+            if switch == dst:
+                out_port = ofp.OFPP_CONTROLLER
+            else:
+                out_port = ports[i]
+            action = [ofp_parser.OFPActionOutput(out_port)]
+            self.add_flow(dp, 1, match, action, cookie)
+        self.delay_paths[(src, dst)] = (version, path)
+        return True
     
-    #Delete rule for delay-calculating packet (used after finish calculating delay)
+    #Delete all rules for delay-calculating packet of a path at once, by their cookie
     def delete_delay_path(self, src, dst):
-        path = self.routing_table[src][dst]
-        for i in range(len(path)):
-                switch = path[i]
-                dp = self.datapaths[switch]
-                ofp_parser = dp.ofproto_parser
-
-                match = ofp_parser.OFPMatch(
-                    eth_type = DelayPacket.DELAY_ETH_TYPE, 
-                    eth_src = ETH_ADD_PREFIX + str(src), 
-                    eth_dst = ETH_ADD_PREFIX + str(dst)
-                )
-                self.delete_flow(dp, match)
+        installed = self.delay_paths.pop((src, dst), None)
+        if installed is None:
+            return
+        for switch in installed[1]:
+            if switch not in self.datapaths:
+                continue
+            dp = self.datapaths[switch]
+            ofp_parser = dp.ofproto_parser
+            self.delete_flow(dp, ofp_parser.OFPMatch(), DelayPacket.cookie(src, dst), DelayPacket.COOKIE_MASK)
     
-    #Delete a flow with a match in a SDN switch
-    def delete_flow(self, datapath, match):
+    #Delete a flow with a match in a SDN switch (only flows with the cookie if a cookie mask is given)
+    def delete_flow(self, datapath, match, cookie = 0, cookie_mask = 0):
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
         command = ofproto.OFPFC_DELETE
 
-        msg = parser.OFPFlowMod(datapath=datapath, match = match, command = command,
+        msg = parser.OFPFlowMod(datapath=datapath, cookie = cookie, cookie_mask = cookie_mask,
+                                match = match, command = command,
                                 out_port = ofproto.OFPP_ANY, out_group=ofproto.OFPG_ANY)
         datapath.send_msg(msg)
 
     #Add a flow to in a SDN switch
-    def add_flow(self, datapath, priority, match, actions):
+    def add_flow(self, datapath, priority, match, actions, cookie = 0):
         # print "Adding flow ", match, actions
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
@@ -359,96 +1049,123 @@ class enode_select(app_manager.RyuApp):
         inst = [parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS,
                                              actions)]
 
-        mod = parser.OFPFlowMod(datapath=datapath, priority=priority,
+        mod = parser.OFPFlowMod(datapath=datapath, cookie=cookie, priority=priority,
                                 match=match, instructions=inst)
         datapath.send_msg(mod)
 
     # Handle delay packet sent to controller from a switch
     @set_ev_cls(ofp_event.EventOFPPacketIn, MAIN_DISPATCHER)
     def packet_in_handler(self, ev): 
-        rx_time = Decimal(time.time())
-        data = ev.msg.data
-        pkt = packet.Packet(data)
-        eth = pkt.get_protocols(ethernet.ethernet)[0]
+        rx_time = time.monotonic_ns() #taken before any parsing
+        data = memoryview(ev.msg.data)
 
-        #check if the packet is the crafted delay-calculating packet
-        if eth.ethertype != DelayPacket.DELAY_ETH_TYPE:
+        #read the ethertype straight from the frame, anything but a delay packet is dropped unparsed
+        if len(data) < DelayPacket.FRAME_SIZE or DelayPacket.ETH_TYPE.unpack_from(data, 12)[0] != DelayPacket.DELAY_ETH_TYPE:
             return
-        
-        eth_src = eth.src
-        eth_dst = eth.dst
-        sw_src = int(eth_src.split(':')[-1])
-        sw_dst = int(eth_dst.split(':')[-1])
-
-        dp = ev.msg.datapath
-        if dp.id == sw_dst:
-            self.delay_end_time[sw_src][sw_dst] = rx_time
-            self.delay_status[sw_src][sw_dst] = 1
-
-    def get_paths(self, src, dst):
-        if src == dst:
-            # host target is on the same switch
-            return [[src]]
-        paths = []
-        stack = [(src, [src])]
-        while stack:
-            (node, path) = stack.pop()
-            for next in set(self.adjacency[node].keys()) - set(path):
-                if next is dst:
-                    paths.append(path + [next])
-                else:
-                    stack.append((next, path + [next]))
-        return paths
-    
-    #Get the shortest path from src switch to dst switch
-    def get_optimal_path(self, src, dst):
-        paths = self.get_paths(src, dst)
-        if not paths:
-            return paths
-        min = len(paths[0]) + 1
-        optimal_path = []
-        for path in paths:
-            if len(path) < min:
-                optimal_path = path
-                min = len(path)
-        return optimal_path
-
-    #Calculate routing table containing
-    def calculate_routing_table(self):
-        start_time = time.time()
-        for i in range(0,len(self.switches) - 1):
-            for j in range (i + 1, len(self.switches)):
-                src = self.switches[i].id
-                dst = self.switches[j].id
-                path = self.get_optimal_path(src,dst)
-                self.routing_table[src][dst] = path
-                self.routing_table[dst][src] = path[::-1]
-        elapsed_time = time.time() - start_time
-        self.logger.info('*****Routing table calculating time:' + str(elapsed_time))
-
-    #Send flowStats request to a switch
-    def request_stats(self, dpid, match):
-        dp = self.datapaths[dpid]
-        parser = dp.ofproto_parser
 
-        msg = parser.OFPFlowStatsRequest(dp,match = match)
+        #match the reply with its probe by the sequence number in the payload
+        seq, send_time = DelayPacket.PAYLOAD.unpack_from(data, 14)
+        probe = self.probes.get(seq)
+        if probe is not None:
+            probe['handler'](probe, ev.msg.datapath.id, rx_time, send_time)
+
+    # Reply of a delay packet sent by send_probe, only the first one at the probed switch counts
+    def probe_reply(self, probe, dpid, rx_time, send_time):
+        if dpid == probe['dst'] and probe['delay'] is None:
+            probe['delay'] = self.compensate_delay(probe['src'], probe['dst'], rx_time - send_time)
+            probe['event'].set()
+
+    #Send a request tagged with a fresh xid, its reply is collected by reply_waiters
+    def send_request(self, dp, msg):
+        dp.set_xid(msg)
+        waiter = {'key': (dp.id, msg.xid), 'event': hub.Event(), 'body': []}
+        self.reply_waiters[waiter['key']] = waiter
         dp.send_msg(msg)
-
-    #Handle port statistics reply
+        return waiter
+
+    #Wait until the whole reply of a request arrived, returns its body (None on timeout)
+    def wait_reply(self, waiter, timeout):
+        done = waiter['event'].wait(timeout=timeout)
+        self.reply_waiters.pop(waiter['key'], None)
+        if not done:
+            return None
+        return waiter['body']
+
+    #Collect a (possibly multipart) reply, the waiter is resolved with the last part
+    def resolve_reply(self, msg):
+        waiter = self.reply_waiters.get((msg.datapath.id, msg.xid))
+        if waiter is None:
+            return # late reply of a request that already timed out
+        body = getattr(msg, 'body', None) # barrier replies have no body
+        if isinstance(body, list):
+            waiter['body'].extend(body)
+        elif body is not None:
+            waiter['body'].append(body)
+        if not getattr(msg, 'flags', 0) & msg.datapath.ofproto.OFPMPF_REPLY_MORE:
+            waiter['time'] = time.monotonic()
+            waiter['event'].set()
+
+    # Background poller: every STATS_INTERVAL, request flow, port and aggregate stats
+    # of all switches at once and append the replies to the ring buffers. Polls are
+    # scheduled on fixed deadlines so waiting for the replies does not stretch the period
+    def stats_monitor(self):
+        next_poll = time.monotonic()
+        while True:
+            # a poll that overran its period starts the next one right away instead of catching up
+            next_poll = max(next_poll + STATS_INTERVAL, time.monotonic())
+            hub.sleep(next_poll - time.monotonic())
+            waiters = []
+            for dp in list(self.datapaths.values()):
+                ofp = dp.ofproto
+                parser = dp.ofproto_parser
+                waiters.append((dp.id, self.flow_stats, self.send_request(dp, parser.OFPFlowStatsRequest(dp))))
+                waiters.append((dp.id, self.port_stats, self.send_request(dp, parser.OFPPortStatsRequest(dp, 0, ofp.OFPP_ANY))))
+                aggregate = parser.OFPAggregateStatsRequest(dp, 0, ofp.OFPTT_ALL, ofp.OFPP_ANY, ofp.OFPG_ANY,
+                                                            0, 0, parser.OFPMatch())
+                waiters.append((dp.id, self.aggregate_stats, self.send_request(dp, aggregate)))
+            deadline = time.monotonic() + min(STATS_TIMEOUT, STATS_INTERVAL)
+            for dpid, buffer, waiter in waiters:
+                body = self.wait_reply(waiter, max(0, deadline - time.monotonic()))
+                if body is not None:
+                    self.record_stats(dpid, buffer, body, waiter['time'])
+
+    # Append the entries of a stats reply body to their ring buffer
+    def record_stats(self, dpid, buffer, body, t):
+        if buffer is self.flow_stats:
+            # only the IPv4 flows between hosts are tracked, keyed by their addresses
+            body = [stat for stat in body if 'ipv4_src' in stat.match and 'ipv4_dst' in stat.match]
+            keys = [(dpid, stat.match['ipv4_src'], stat.match['ipv4_dst']) for stat in body]
+        elif buffer is self.port_stats:
+            keys = [(dpid, stat.port_no) for stat in body]
+        else:
+            keys = [dpid for stat in body]
+        # several rules can match the same addresses (e.g. tagged and untagged outbound
+        # rules), their counters are summed so every key is appended once
+        values = {}
+        for key, stat in zip(keys, body):
+            counters = [getattr(stat, field) for field in buffer.fields]
+            values[key] = [a + b for a, b in zip(values[key], counters)] if key in values else counters
+        buffer.append(list(values.keys()), t, list(values.values()))
+
+    #Handle flow statistics reply
     @set_ev_cls(ofp_event.EventOFPFlowStatsReply, MAIN_DISPATCHER)
     def handle_port_stat_reply(self, ev):
-        msg = ev.msg
-        dp = msg.datapath
-        body = msg.body
-        for stat in body:
-            src_ip = stat.match.get('ipv4_src')
-            src_dpid = int(src_ip.split('.')[-1])
-            dst_ip = stat.match.get('ipv4_dst')
-            dst_dpid = int(dst_ip.split('.')[-1])
-            if dp.id == src_dpid:
-                self.tx_flow_stats[src_dpid][dst_dpid] = stat.packet_count
-            if dp.id == dst_dpid:
-                self.rx_flow_stats[src_dpid][dst_dpid] = stat.packet_count
+        self.resolve_reply(ev.msg)
+
+    #Handle barrier reply
+    @set_ev_cls(ofp_event.EventOFPBarrierReply, MAIN_DISPATCHER)
+    def barrier_reply_handler(self, ev):
+        self.resolve_reply(ev.msg)
+
+    #Handle port statistics reply
+    @set_ev_cls(ofp_event.EventOFPPortStatsReply, MAIN_DISPATCHER)
+    def port_stats_reply_handler(self, ev):
+        self.resolve_reply(ev.msg)
+
+    #Handle aggregate flow statistics reply
+    @set_ev_cls(ofp_event.EventOFPAggregateStatsReply, MAIN_DISPATCHER)
+    def aggregate_stats_reply_handler(self, ev):
+        self.resolve_reply(ev.msg)
         
     #Handle a switch enter or leave network
     @set_ev_cls(ofp_event.EventOFPStateChange,[MAIN_DISPATCHER, DEAD_DISPATCHER])
@@ -459,11 +1176,17 @@ class enode_select(app_manager.RyuApp):
                 # self.logger.info('A switch connect - dpid: %016x', datapath.id)
                 self.switches.append(datapath)
                 self.datapaths[datapath.id] = datapath
+                self.routing_table.add_switch(datapath.id)
+                self.routing_table.warm_up(INGRESS_NODES)
+                self.delay_table.add_switch(datapath.id)
         elif ev.state == DEAD_DISPATCHER:
             if datapath.id in self.datapaths:
                 self.logger.info('A switch has just disconnected - dpid: %016x', datapath.id)
                 del self.datapaths[datapath.id]
                 self.switches.remove(datapath)
+                self.routing_table.remove_switch(datapath.id)
+                self.routing_table.warm_up(INGRESS_NODES)
+                self.delay_table.remove_switch(datapath.id)
 
     #Handle event a link added to the network topology
     @set_ev_cls(event.EventLinkAdd, MAIN_DISPATCHER)
@@ -472,6 +1195,13 @@ class enode_select(app_manager.RyuApp):
         s2 = ev.link.dst
         self.adjacency[s1.dpid][s2.dpid] = s1.port_no
         self.adjacency[s2.dpid][s1.dpid] = s2.port_no
+        self.routing_table.link_added(s1.dpid, s2.dpid)
+        self.routing_table.warm_up(INGRESS_NODES) # only the ingress tree is needed for egress selection
+        for link in ((s1.dpid, s2.dpid), (s2.dpid, s1.dpid)):
+            if link not in self.link_delays: # not probed yet
+                self.delay_table.set_link_weight(link[0], link[1], self.calculate_reward(0, 0) - self.calculate_reward(0, UNKNOWN_LINK_DELAY))
+        self.delay_table.link_added(s1.dpid, s2.dpid)
+        self.update_availability()
 
     #Handle event a link deleted from the network topology
     @set_ev_cls(event.EventLinkDelete, MAIN_DISPATCHER)
@@ -484,22 +1214,39 @@ class enode_select(app_manager.RyuApp):
             del self.adjacency[s2.dpid][s1.dpid]
         except KeyError:
             pass
+        self.routing_table.link_deleted(s1.dpid, s2.dpid)
+        self.routing_table.warm_up(INGRESS_NODES)
+        self.delay_table.link_deleted(s1.dpid, s2.dpid)
+        self.link_down(s1.dpid, s2.dpid)
 
 # Customized packet used to calculating delay
 class DelayPacket(object):
     DELAY_ETH_TYPE = 0x7777 #Special ethernet type used only for delay-calculating packet
 
+    PAYLOAD_FORMAT = '!IQ' #Sequence number and sending time (monotonic ns) of the delay packet
+    ETH_TYPE = struct.Struct('!H') #Ethernet type, at offset 12 of the frame
+    PAYLOAD = struct.Struct(PAYLOAD_FORMAT) #Payload, right after the 14 bytes ethernet header
+    FRAME_SIZE = 14 + PAYLOAD.size
+    COOKIE_PREFIX = 0x7777 << 48 #Cookie of delay packet rules, followed by the src and dst switch of the path
+    COOKIE_MASK = 0xffffffffffffffff
+
+    #MAC address of switch dpid in the delay packets, the last three bytes are the dpid
     @staticmethod
-    def delay_packet(eth_src, eth_dst, payload = ''):
-        # pkt = packet.Packet(data=payload)
+    def eth_addr(dpid):
+        return ETH_ADD_PREFIX + '%02x:%02x:%02x' % ((dpid >> 16) & 0xff, (dpid >> 8) & 0xff, dpid & 0xff)
+
+    @staticmethod
+    def cookie(src, dst):
+        return DelayPacket.COOKIE_PREFIX | (src << 24) | dst
+
+    @staticmethod
+    def delay_packet(eth_src, eth_dst, seq, send_time):
         pkt = packet.Packet()
 
         ethernet_pkt = ethernet.ethernet(dst=eth_dst, src=eth_src,
                                         ethertype=DelayPacket.DELAY_ETH_TYPE)
         pkt.add_protocol(ethernet_pkt)
-        ip_pk = ipv4.ipv4()
-        pkt.add_protocol(ip_pk)
+        pkt.add_protocol(struct.pack(DelayPacket.PAYLOAD_FORMAT, seq, send_time))
         pkt.serialize()
 
         return pkt.data
-
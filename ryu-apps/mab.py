@@ -7,27 +7,127 @@
 # algorithms implementation
 
 import math
+import os
 import numpy as np
 
+# Statistics of every arm of a MAB model kept in contiguous arrays,
+# so that choosing an arm is a single vectorized expression
+class ArmState(object):
+    ARRAYS = ('N', 'pulls', 'mean', 's') # per-arm arrays, saved in checkpoints
+
+    def __init__(self, action_num):
+        self.N = np.zeros(action_num, dtype=np.int64) # rewards observed for each arm
+        self.pulls = np.zeros(action_num, dtype=np.int64) # times each arm was chosen and rewarded
+        self.mean = np.zeros(action_num) # mean reward of each arm
+        self.s = np.ones(action_num) # SP-UCB2 counters
+        self.total = 0 # running sum of N
+
+    def update(self, i, reward):
+        self.pulls[i] += 1
+        self.observe(i, reward)
+
+    # Reward of an arm that was not pulled (side information)
+    def observe(self, i, reward):
+        self.N[i] += 1
+        self.total += 1
+        self.mean[i] += (reward - self.mean[i]) / self.N[i]
+
 # MAB superclass
 class MAB(object):
+    ARM_ARRAYS = () # names of the per-arm arrays (first axis) of the algorithm, saved in checkpoints
+
     def __init__(self, actions, action_num):
         self.actions = actions
         self.action_num = action_num
+        self.state = ArmState(action_num)
+        # actions become views on the model arrays, keeping what they learnt so far
+        for i in range(action_num):
+            action = actions[i]
+            self.state.N[i] = action.N
+            self.state.pulls[i] = action.pulls
+            self.state.mean[i] = action.mean
+            action.bind(self, self.state, i)
+        self.state.total = int(self.state.N.sum())
+        self.available = np.ones(action_num, dtype=bool) # arms that can be chosen
+
+    # Arms that are not available (e.g. egress nodes that cannot be reached) are never
+    # chosen, unless none is available
+    def set_available(self, i, available):
+        self.available[i] = available
+
+    # Scores of the unavailable arms replaced by -inf
+    def masked(self, scores):
+        if not self.available.any():
+            return scores
+        return np.where(self.available, scores, -np.inf)
+
+    # Index of the available arm with the highest score
+    def best(self, scores):
+        return np.argmax(self.masked(scores))
+
+    # Reward the i-th arm, Action.update ends up here
+    def update(self, i, reward):
+        self.state.update(i, reward)
+
+    # Observe a reward of the i-th arm without pulling it, e.g. from probing a path
+    # no traffic is sent on. It sharpens the mean of the arm like a pull does.
+    def observe(self, i, reward):
+        self.state.observe(i, reward)
+
+    # Features of every arm (action_num x features) for the next choice and its rewards,
+    # only contextual bandits use them
+    def set_contexts(self, contexts):
+        pass
+
+    # Per-arm arrays of the algorithm by name, those not allocated yet are left out
+    def arm_arrays(self):
+        return dict((name, getattr(self, name)) for name in self.ARM_ARRAYS if getattr(self, name) is not None)
 
+    # Copy values into the rows of a per-arm array
+    def restore_arm_array(self, name, rows, values):
+        getattr(self, name)[rows] = values
+
+    # Arrays of the algorithm by name that are not per arm (e.g. a window of rewards),
+    # saved in checkpoints too
+    def window_arrays(self):
+        return {}
+
+    # Restore them from a checkpoint whose arm saved_rows[k] became arm rows[k]
+    def restore_window(self, arrays, rows, saved_rows):
+        pass
+
+# A single arm, a thin view on its slot in the arrays of a MAB model
 class Action(object):
     def __init__(self, id):
         self.id = id
-        self.mean = 0
-        self.N = 0
-    
+        self.bind(None, ArmState(1), 0)
+
+    def bind(self, model, state, index):
+        self.model = model
+        self.state = state
+        self.index = index
+
+    @property
+    def mean(self):
+        return float(self.state.mean[self.index])
+
+    @property
+    def N(self):
+        return int(self.state.N[self.index])
+
+    @property
+    def pulls(self):
+        return int(self.state.pulls[self.index])
+
     def update(self, reward):
-        self.N += 1
-        self.mean = 1.0 * reward / self.N + (1 - 1.0/self.N) * self.mean 
-        
+        if self.model is None:
+            self.state.update(self.index, reward)
+        else:
+            self.model.update(self.index, reward)
+
     def __repr__(self):
-        return "id:" + str(self.id) + " ChoosenTime:" + str(self.N) + " MeanReward:" + str(self.mean)
-    
+        return "id:" + str(self.id) + " ChoosenTime:" + str(self.pulls) + " MeanReward:" + str(self.mean)
+
 # epsilon-greedy class
 class egreedy(MAB):
     def __init__(self, actions, action_num, eps):
@@ -37,9 +137,10 @@ class egreedy(MAB):
     def choose_action(self):
         p = np.random.random()
         if p < self.eps:
-            j = np.random.choice(self.action_num)
+            candidates = np.flatnonzero(self.available) if self.available.any() else np.arange(self.action_num)
+            j = np.random.choice(candidates)
         else:
-            j = np.argmax([action.mean for action in self.actions])
+            j = self.best(self.state.mean)
         x = self.actions[j]
         return x
 
@@ -49,50 +150,414 @@ class softmax(MAB):
         super(softmax, self).__init__(actions, action_num)
         self.tau = tau
 
+    # Single draw over the cumulative weights, shifted by the max mean to avoid overflow
     def choose_action(self):
-        z = sum([math.exp(a.mean / self.tau) for a in self.actions])
-        probs = [math.exp(a.mean / self.tau) / z for a in self.actions]
-
-        p = np.random.random()
-        cumm_prob = 0.0
-        for i in range(len(self.actions)):
-            cumm_prob += probs[i]
-            if cumm_prob > p:
-                return self.actions[i]
-        return self.actions[-1]
+        mean = self.masked(self.state.mean)
+        cumm_prob = np.cumsum(np.exp((mean - mean.max()) / self.tau))
+        p = np.random.random() * cumm_prob[-1]
+        i = min(np.searchsorted(cumm_prob, p, side='right'), self.action_num - 1)
+        return self.actions[i]
 
 #UCB1 class
 class UCB1(MAB):
     def __init__(self, actions, action_num):
         super(UCB1, self).__init__(actions, action_num)
-    
+
+    # arms that were never rewarded get an infinite index
+    def indexes(self):
+        timestep = self.state.total + 1
+        N = self.state.N
+        bonus = np.full(self.action_num, np.inf)
+        np.sqrt(2 * math.log10(timestep) / np.maximum(N, 1), out=bonus, where=N > 0)
+        return self.state.mean + bonus
+
     def choose_action(self):
-        timestep = sum([a.N for a in self.actions]) + 1
-        indexs = [a.mean + math.sqrt(2 * math.log10(timestep) / a.N) for a in self.actions]
-        choosen = np.argmax(indexs)
+        choosen = self.best(self.indexes())
         return self.actions[choosen]
 
 #SP_UCB2 class
 class SP_UCB2(MAB):
     def __init__(self, actions, action_num, alpha):
         super(SP_UCB2, self).__init__(actions, action_num)
-        self.s = [1 for col in self.actions]
+        self.s = self.state.s
         self.alpha = alpha
-    
+
     def tau(self, x):
         return (1 + self.alpha) ** x
-    
+
     def upper_bound(self, t,s):
-        return math.sqrt((1 + self.alpha) * max(1,math.log10(math.e * t))/ (2 * s))
+        return np.sqrt((1 + self.alpha) * max(1,math.log10(math.e * t))/ (2 * s))
+
+    def indexes(self):
+        timestep = self.state.total + 1
+        return self.state.mean + self.upper_bound(timestep, self.s)
 
     def choose_action(self):
-        timestep = sum([a.N for a in self.actions]) + 1
-        indexs = []
-        for i in range(self.action_num):
-            action = self.actions[i]
-            s = self.s[i]
-            value = action.mean + self.upper_bound(timestep, s)
-            indexs.append(value)
-        choosen = np.argmax(indexs)
+        choosen = self.best(self.indexes())
         self.s[choosen] += 1
-        return self.actions[choosen]
\ No newline at end of file
+        return self.actions[choosen]
+
+# Index of arms from (discounted or windowed) reward counts and sums: their mean plus
+# B * sqrt(xi * log(n) / counts), n being the total count. Arms without rewards get an
+# infinite index. Works on the rows of 2-D arrays too, n then being a column.
+def ucb_index(counts, sums, n, xi, B):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        index = (sums + B * np.sqrt(xi * np.log(np.maximum(n, 1)) * counts)) / counts
+    return np.where(counts > 0, index, np.inf)
+
+#Discounted UCB class (Garivier & Moulines), a reward observed k pulls ago weighs gamma ** k,
+#so the bandit follows arms whose reward changes over time
+class D_UCB(MAB):
+    ARM_ARRAYS = ('counts', 'sums')
+
+    def __init__(self, actions, action_num, gamma, xi=0.6, B=1):
+        super(D_UCB, self).__init__(actions, action_num)
+        self.gamma = gamma
+        self.xi = xi
+        self.B = B
+        self.counts = np.zeros(action_num) # discounted number of rewards of each arm
+        self.sums = np.zeros(action_num) # discounted sum of rewards of each arm
+
+    def update(self, i, reward):
+        self.counts *= self.gamma
+        self.sums *= self.gamma
+        self.state.pulls[i] += 1
+        self.observe(i, reward)
+
+    def observe(self, i, reward):
+        self.state.observe(i, reward)
+        self.counts[i] += 1
+        self.sums[i] += reward
+
+    def indexes(self):
+        return ucb_index(self.counts, self.sums, self.counts.sum(), self.xi, 2 * self.B)
+
+    def choose_action(self):
+        choosen = self.best(self.indexes())
+        return self.actions[choosen]
+
+#Sliding-Window UCB class (Garivier & Moulines), only the last window rewards count.
+#They are kept in a ring buffer, counts and sums are updated as rewards enter and leave it
+class SW_UCB(MAB):
+    def __init__(self, actions, action_num, window, xi=0.6, B=1):
+        super(SW_UCB, self).__init__(actions, action_num)
+        self.window = window
+        self.xi = xi
+        self.B = B
+        self.arms = np.full(window, -1, dtype=np.int64) # arm of each reward in the window, -1 if empty
+        self.rewards = np.zeros(window)
+        self.head = 0 # slot of the next reward
+        self.seen = 0 # rewards ever observed
+        self.counts = np.zeros(action_num, dtype=np.int64) # rewards of each arm in the window
+        self.sums = np.zeros(action_num) # sum of the rewards of each arm in the window
+
+    def update(self, i, reward):
+        self.state.pulls[i] += 1
+        self.observe(i, reward)
+
+    def observe(self, i, reward):
+        self.state.observe(i, reward)
+        self.slide(i, reward)
+
+    # Push a reward in the window, evicting the oldest one
+    def slide(self, i, reward):
+        old = self.arms[self.head]
+        if old >= 0:
+            self.counts[old] -= 1
+            self.sums[old] = self.sums[old] - self.rewards[self.head] if self.counts[old] else 0
+        self.arms[self.head] = i
+        self.rewards[self.head] = reward
+        self.counts[i] += 1
+        self.sums[i] += reward
+        self.head = (self.head + 1) % self.window
+        self.seen += 1
+
+    # Rewards in the window, oldest first
+    def window_arrays(self):
+        order = (self.head + np.arange(self.window)) % self.window
+        return {'arms': self.arms[order], 'rewards': self.rewards[order]}
+
+    # The saved rewards of the restored arms enter the window again, in the same order
+    def restore_window(self, arrays, rows, saved_rows):
+        restored = dict(zip(saved_rows, rows))
+        for arm, reward in zip(arrays['arms'].tolist(), arrays['rewards'].tolist()):
+            if arm in restored:
+                self.slide(restored[arm], reward)
+
+    def indexes(self):
+        return ucb_index(self.counts, self.sums, min(self.seen, self.window), self.xi, self.B)
+
+    def choose_action(self):
+        choosen = self.best(self.indexes())
+        return self.actions[choosen]
+
+#Gaussian Thompson sampling class, each arm's mean reward has a normal posterior
+#(prior N(mu0, tau0^2), rewards with noise of standard deviation sigma) and the arm
+#with the best draw from it is chosen
+class GaussianThompson(MAB):
+    def __init__(self, actions, action_num, sigma, mu0=0, tau0=100):
+        super(GaussianThompson, self).__init__(actions, action_num)
+        self.sigma = sigma
+        self.mu0 = mu0
+        self.tau0 = tau0
+
+    def choose_action(self):
+        precision = 1.0 / self.tau0 ** 2 + self.state.N / self.sigma ** 2
+        mean = (self.mu0 / self.tau0 ** 2 + self.state.N * self.state.mean / self.sigma ** 2) / precision
+        choosen = self.best(np.random.normal(mean, 1 / np.sqrt(precision)))
+        return self.actions[choosen]
+
+#Beta-Bernoulli Thompson sampling class, a reward scaled from [low, high] to [0, 1] is
+#the probability of a success, each arm keeps a Beta(successes + 1, failures + 1) posterior
+class BetaThompson(MAB):
+    ARM_ARRAYS = ('alpha', 'beta')
+
+    def __init__(self, actions, action_num, high, low=0):
+        super(BetaThompson, self).__init__(actions, action_num)
+        self.high = high
+        self.low = low
+        self.alpha = np.ones(action_num)
+        self.beta = np.ones(action_num)
+
+    def update(self, i, reward):
+        self.state.pulls[i] += 1
+        self.observe(i, reward)
+
+    def observe(self, i, reward):
+        self.state.observe(i, reward)
+        p = min(max((reward - self.low) / float(self.high - self.low), 0), 1)
+        success = np.random.random() < p
+        self.alpha[i] += success
+        self.beta[i] += 1 - success
+
+    def choose_action(self):
+        choosen = self.best(np.random.beta(self.alpha, self.beta))
+        return self.actions[choosen]
+
+#LinUCB class (Li et al., disjoint model), the reward of an arm is linear in its features.
+#Each arm keeps the inverse of its ridge regression matrix, updated in place with the
+#Sherman-Morrison formula, so that no matrix is ever inverted.
+#The features are given by set_contexts before each choice.
+class LinUCB(MAB):
+    ARM_ARRAYS = ('A_inv', 'b')
+
+    def __init__(self, actions, action_num, alpha, features=None):
+        super(LinUCB, self).__init__(actions, action_num)
+        self.alpha = alpha
+        self.contexts = None # features of every arm for the current choice
+        self.A_inv = None
+        if features is not None:
+            self.allocate(features)
+
+    # Arrays of the model, A_inv[i] = inverse of A_i = I + sum(x x^T) and b[i] = sum(reward * x)
+    def allocate(self, features):
+        self.A_inv = np.tile(np.eye(features), (self.action_num, 1, 1))
+        self.b = np.zeros((self.action_num, features))
+
+    def set_contexts(self, contexts):
+        contexts = np.asarray(contexts, dtype=float)
+        if self.A_inv is None:
+            self.allocate(contexts.shape[1])
+        self.contexts = contexts
+
+    def restore_arm_array(self, name, rows, values):
+        if self.A_inv is None:
+            self.allocate(values.shape[-1])
+        super(LinUCB, self).restore_arm_array(name, rows, values)
+
+    def indexes(self):
+        x = self.contexts
+        theta = np.einsum('kij,kj->ki', self.A_inv, self.b)
+        Ax = np.einsum('kij,kj->ki', self.A_inv, x)
+        return np.einsum('ki,ki->k', x, theta) + self.alpha * np.sqrt(np.einsum('ki,ki->k', x, Ax))
+
+    def choose_action(self):
+        choosen = self.best(self.indexes())
+        return self.actions[choosen]
+
+    def update(self, i, reward):
+        self.state.pulls[i] += 1
+        self.observe(i, reward)
+
+    def observe(self, i, reward):
+        self.state.observe(i, reward)
+        x = self.contexts[i]
+        Ax = self.A_inv[i].dot(x)
+        self.A_inv[i] -= np.outer(Ax, Ax) / (1 + x.dot(Ax))
+        self.b[i] += reward * x
+
+# Save what a MAB model learnt in a NumPy npz file, so that a restarted controller
+# goes on from it. fingerprint identifies the setting the model learns in and
+# arm_fingerprints[i] the i-th arm (e.g. its path). The file is replaced atomically.
+def save_checkpoint(filename, model, fingerprint, arm_fingerprints):
+    arrays = {
+        'fingerprint': np.array(fingerprint),
+        'ids': np.array([action.id for action in model.actions]),
+        'arm_fingerprints': np.array(arm_fingerprints),
+    }
+    for name in ArmState.ARRAYS:
+        arrays['state.' + name] = getattr(model.state, name)
+    for name, value in model.arm_arrays().items():
+        arrays['model.' + name] = value
+    for name, value in model.window_arrays().items():
+        arrays['window.' + name] = value
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez(f, **arrays)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, filename)
+
+# Restore the arms of a MAB model saved with the same fingerprint and arm fingerprint,
+# returns the indexes of the restored arms (none if the file is missing or unreadable).
+# Arms with an empty fingerprint (e.g. no path yet) are never restored
+def load_checkpoint(filename, model, fingerprint, arm_fingerprints):
+    try:
+        data = np.load(filename)
+    except (IOError, ValueError):
+        return []
+    with data:
+        if str(data['fingerprint']) != fingerprint:
+            return []
+        saved = dict((key, k) for k, key in enumerate(zip(data['ids'].tolist(), data['arm_fingerprints'].tolist())))
+        rows, saved_rows = [], []
+        for i in range(model.action_num):
+            k = saved.get((model.actions[i].id, arm_fingerprints[i]))
+            if k is not None and arm_fingerprints[i]:
+                rows.append(i)
+                saved_rows.append(k)
+        if not rows:
+            return []
+        for name in ArmState.ARRAYS:
+            getattr(model.state, name)[rows] = data['state.' + name][saved_rows]
+        for name in model.ARM_ARRAYS:
+            if 'model.' + name in data:
+                model.restore_arm_array(name, rows, data['model.' + name][saved_rows])
+        model.restore_window(dict((key[len('window.'):], data[key]) for key in data.files if key.startswith('window.')),
+                             rows, saved_rows)
+    model.state.total = int(model.state.N.sum())
+    return rows
+
+# Many independent bandits over the same arms (e.g. one per ingress switch).
+# Their state is kept in (instances x arms) arrays, so choosing an arm for
+# every instance or rewarding all of them is a single NumPy operation.
+# algorithm is one of 'egreedy', 'softmax', 'UCB1', 'SP_UCB2', 'D_UCB', 'SW_UCB'
+# and param its eps, tau, alpha, gamma or window.
+class BatchMAB(object):
+    ALGORITHMS = ('egreedy', 'softmax', 'UCB1', 'SP_UCB2', 'D_UCB', 'SW_UCB')
+
+    # param is the parameter of the algorithm like for its MAB class, for D_UCB and SW_UCB
+    # optionally a tuple (discount factor or window, xi, B)
+    def __init__(self, instances, action_num, algorithm, param=None):
+        if algorithm not in self.ALGORITHMS:
+            raise ValueError('Unknown MAB algorithm: ' + str(algorithm))
+        self.instances = instances
+        self.action_num = action_num
+        self.algorithm = algorithm
+        self.xi = 0.6 # exploration factor of D_UCB and SW_UCB
+        self.B = 1 # range of the rewards of D_UCB and SW_UCB
+        if isinstance(param, tuple):
+            param, self.xi, self.B = param
+        self.param = param
+        self.rows = np.arange(instances)
+        self.N = np.zeros((instances, action_num), dtype=np.int64)
+        self.pulls = np.zeros((instances, action_num), dtype=np.int64)
+        self.mean = np.zeros((instances, action_num))
+        self.s = np.ones((instances, action_num)) # SP-UCB2 counters
+        self.total = np.zeros(instances, dtype=np.int64) # running sum of N per instance
+        self.counts = np.zeros((instances, action_num)) # discounted or windowed N (D_UCB, SW_UCB)
+        self.sums = np.zeros((instances, action_num)) # discounted or windowed sum of rewards
+        if algorithm == 'SW_UCB':
+            window = int(param)
+            self.window_arms = np.full((instances, window), -1, dtype=np.int64)
+            self.window_rewards = np.zeros((instances, window))
+            self.head = np.zeros(instances, dtype=np.int64)
+            self.seen = np.zeros(instances, dtype=np.int64)
+
+    # Index of the chosen arm for every instance
+    def choose_actions(self):
+        return getattr(self, 'choose_' + self.algorithm)()
+
+    def choose_egreedy(self):
+        explore = np.random.random(self.instances) < self.param
+        random_arms = np.random.randint(self.action_num, size=self.instances)
+        return np.where(explore, random_arms, np.argmax(self.mean, axis=1))
+
+    def choose_softmax(self):
+        z = (self.mean - self.mean.max(axis=1, keepdims=True)) / self.param
+        cumm_prob = np.cumsum(np.exp(z), axis=1)
+        p = np.random.random((self.instances, 1)) * cumm_prob[:, -1:]
+        return np.minimum((cumm_prob <= p).sum(axis=1), self.action_num - 1)
+
+    def choose_UCB1(self):
+        timestep = (self.total + 1)[:, None]
+        bonus = np.full(self.N.shape, np.inf)
+        np.sqrt(2 * np.log10(timestep) / np.maximum(self.N, 1), out=bonus, where=self.N > 0)
+        return np.argmax(self.mean + bonus, axis=1)
+
+    def choose_SP_UCB2(self):
+        timestep = (self.total + 1)[:, None]
+        bound = np.sqrt((1 + self.param) * np.maximum(1, np.log10(math.e * timestep)) / (2 * self.s))
+        choosen = np.argmax(self.mean + bound, axis=1)
+        self.s[self.rows, choosen] += 1
+        return choosen
+
+    def choose_D_UCB(self):
+        n = self.counts.sum(axis=1, keepdims=True)
+        return np.argmax(ucb_index(self.counts, self.sums, n, self.xi, 2 * self.B), axis=1)
+
+    def choose_SW_UCB(self):
+        n = np.minimum(self.seen, self.window_rewards.shape[1])[:, None]
+        return np.argmax(ucb_index(self.counts, self.sums, n, self.xi, self.B), axis=1)
+
+    # Reward arms[k] of instances[k] with rewards[k] (all instances by default)
+    def update(self, arms, rewards, instances=None):
+        rows = self.rows if instances is None else np.asarray(instances)
+        self.pulls[rows, np.asarray(arms)] += 1
+        if self.algorithm == 'D_UCB':
+            self.counts[rows] *= self.param
+            self.sums[rows] *= self.param
+        self.observe(arms, rewards, rows)
+
+    # Side information: rewards[k] observed for arms[k] of instances[k] without a pull,
+    # an instance may appear several times but each (instance, arm) pair only once
+    def observe(self, arms, rewards, instances=None):
+        rows = self.rows if instances is None else np.asarray(instances)
+        arms = np.asarray(arms)
+        rewards = np.asarray(rewards)
+        self.N[rows, arms] += 1
+        np.add.at(self.total, rows, 1)
+        self.mean[rows, arms] += (rewards - self.mean[rows, arms]) / self.N[rows, arms]
+        if self.algorithm == 'D_UCB':
+            self.counts[rows, arms] += 1
+            self.sums[rows, arms] += rewards
+        elif self.algorithm == 'SW_UCB':
+            for row, arm, reward in zip(rows, arms, rewards):
+                self.slide(row, arm, reward)
+
+    # Push a reward in the window of an instance, evicting its oldest one
+    def slide(self, row, arm, reward):
+        head = self.head[row]
+        old = self.window_arms[row, head]
+        if old >= 0:
+            self.counts[row, old] -= 1
+            self.sums[row, old] = self.sums[row, old] - self.window_rewards[row, head] if self.counts[row, old] else 0
+        self.window_arms[row, head] = arm
+        self.window_rewards[row, head] = reward
+        self.counts[row, arm] += 1
+        self.sums[row, arm] += reward
+        self.head[row] = (head + 1) % self.window_rewards.shape[1]
+        self.seen[row] += 1
+
+# MAB classes by name, e.g. to pick one from a setting
+MAB_ALGORITHMS = {
+    'egreedy': egreedy,
+    'softmax': softmax,
+    'UCB1': UCB1,
+    'SP_UCB2': SP_UCB2,
+    'D_UCB': D_UCB,
+    'SW_UCB': SW_UCB,
+    'GaussianThompson': GaussianThompson,
+    'BetaThompson': BetaThompson,
+    'LinUCB': LinUCB,
+}
@@ -0,0 +1,462 @@
+# This is a part of the program in the article:
+#  "A Reinforcement Learning-Based Solution for Intra-Domain Egress Selection"
+#  Authors: Duc-Huy LE, Hai Anh TRAN, Sami SOUIHI
+#  Conference: HPSR2021
+
+# This is a library computing shortest paths over the switch adjacency map
+# (adjacency[s1][s2] = port of s1 that links to s2). Paths are read from
+# single-source shortest path trees: BFS for hop-count routing, Dijkstra when
+# link weights are given. A full routing table costs O(V*(V+E)).
+
+import heapq
+import multiprocessing
+import os
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+NO_SWITCH = -1 # predecessor of unreachable switches (and of the tree root)
+NO_PORT = 0 # out port of switch pairs that are not linked
+
+# IP address of the host attached to switch dpid: 10.0.0.dpid as in the mininet scripts,
+# continued in 10.0.1.0/24 and above for networks of more than 255 switches
+def host_ip(dpid):
+    return '10.%d.%d.%d' % ((dpid >> 16) & 0xff, (dpid >> 8) & 0xff, dpid & 0xff)
+
+# Single-source shortest path tree rooted at src
+# Returns (pred, dist): pred[v] is the previous switch of v in the tree,
+# dist[v] the hop count (or total weight) from src to v.
+# If nodes is given, switches outside of it are not traversed,
+# neither are the (s1, s2) links in banned.
+def shortest_path_tree(adjacency, src, weights=None, nodes=None, banned=()):
+    if weights is None:
+        return bfs_tree(adjacency, src, nodes, banned)
+    return dijkstra_tree(adjacency, src, weights, nodes, banned)
+
+# Breadth-first tree, every link counts as one hop
+def bfs_tree(adjacency, src, nodes=None, banned=()):
+    pred = {src: None}
+    dist = {src: 0}
+    queue = deque([src])
+    while queue:
+        node = queue.popleft()
+        for next in sorted(adjacency[node]):
+            if next not in dist and (nodes is None or next in nodes) and (node, next) not in banned:
+                pred[next] = node
+                dist[next] = dist[node] + 1
+                queue.append(next)
+    return pred, dist
+
+# Dijkstra tree, weights[s1][s2] is the cost of link s1-s2 (default 1)
+def dijkstra_tree(adjacency, src, weights, nodes=None, banned=()):
+    pred = {src: None}
+    dist = {src: 0}
+    done = set()
+    heap = [(0, src)]
+    while heap:
+        d, node = heapq.heappop(heap)
+        if node in done:
+            continue
+        done.add(node)
+        for next in sorted(adjacency[node]):
+            if (nodes is not None and next not in nodes) or (node, next) in banned:
+                continue
+            w = weights.get(node, {}).get(next, 1)
+            if next not in dist or d + w < dist[next]:
+                dist[next] = d + w
+                pred[next] = node
+                heapq.heappush(heap, (d + w, next))
+    return pred, dist
+
+# Walk the predecessor map back from dst, [] if dst is not reachable
+def tree_path(pred, src, dst):
+    if dst not in pred:
+        return []
+    path = [dst]
+    while path[-1] != src:
+        path.append(pred[path[-1]])
+    return path[::-1]
+
+# Shortest path between a single pair of switches
+def shortest_path(adjacency, src, dst, weights=None):
+    pred, _ = shortest_path_tree(adjacency, src, weights)
+    return tree_path(pred, src, dst)
+
+# Total weight of a path
+def path_cost(path, weights=None):
+    if weights is None:
+        return len(path) - 1
+    return sum(weights.get(s1, {}).get(s2, 1) for s1, s2 in zip(path[:-1], path[1:]))
+
+# Up to k loopless paths from src to dst by increasing cost (Yen's algorithm), first
+# being the shortest one if already known. Each next path deviates from a known one at
+# a spur switch: the shortest path from there that leaves the known root through a new
+# link and does not come back to the root
+def k_shortest_paths(adjacency, src, dst, k, weights=None, nodes=None, first=None):
+    if first is None:
+        first = shortest_path(adjacency, src, dst, weights)
+    if not first:
+        return []
+    nodes = set(adjacency if nodes is None else nodes)
+    paths = [first]
+    candidates = [] # heap of (cost, path) of the deviations found so far
+    seen = set([tuple(first)])
+    while len(paths) < k:
+        last = paths[-1]
+        for i in range(len(last) - 1):
+            root = last[:i + 1]
+            banned = set((path[i], path[i + 1]) for path in paths if path[:i + 1] == root)
+            pred, _ = shortest_path_tree(adjacency, last[i], weights, nodes - set(root[:-1]), banned)
+            spur = tree_path(pred, last[i], dst)
+            if not spur:
+                continue
+            path = root[:-1] + spur
+            if tuple(path) not in seen:
+                seen.add(tuple(path))
+                heapq.heappush(candidates, (path_cost(path, weights), path))
+        if not candidates:
+            break
+        paths.append(heapq.heappop(candidates)[1])
+    return paths
+
+# Shortest path trees of the given sources over a snapshot of the topology, meant to
+# run in a worker process: links[i, j] is True if switch index i links to j and
+# weights[i, j] is the cost of that link (None for hop count).
+# Returns (pred, dist) matrices with one row per source, indexed like links
+def compute_trees(links, sources, weights=None):
+    n = len(links)
+    adjacency = dict((i, np.flatnonzero(links[i]).tolist()) for i in range(n))
+    if weights is not None:
+        weights = dict((i, dict((j, float(weights[i, j])) for j in adjacency[i])) for i in range(n))
+    pred = np.full((len(sources), n), NO_SWITCH, dtype=np.int32)
+    dist = np.full((len(sources), n), np.inf, dtype=np.float32)
+    for k, src in enumerate(sources):
+        tree_pred, tree_dist = shortest_path_tree(adjacency, src, weights)
+        for node, prev in tree_pred.items():
+            dist[k, node] = tree_dist[node]
+            if prev is not None:
+                pred[k, node] = prev
+    return pred, dist
+
+# Process pool for compute_trees. Workers are spawned rather than forked so they do
+# not inherit the state of the controller's event loop
+def routing_executor(workers=None):
+    return ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+
+# Routing table kept up to date from topology events.
+# Trees are stored compactly: switches get a matrix index, self.pred[i, j] is
+# the index of the switch before j in the tree rooted at i, self.dist[i, j]
+# its distance and self.ports[i, j] the port of i that links to j.
+# routing_table[s1][s2] still gives the path as a list of switch IDs, rebuilt
+# on demand and kept in a bounded LRU cache for the hot pairs.
+# Trees are computed lazily, only for the sources that are asked for, and stay
+# memoized across topology versions as long as no change can affect them:
+# a link change only invalidates the trees that it can affect and every
+# change bumps self.version.
+class RoutingTable(object):
+    def __init__(self, adjacency, weights=None, capacity=64, cache_size=1024):
+        self.adjacency = adjacency # shared with the app, updated by its link handlers
+        self.weights = weights
+        self.version = 0
+        self.index = {} # self.index[dpid] = matrix index of the switch
+        self.dpids = [] # self.dpids[i] = dpid of the switch with index i (None if free)
+        self.free = [] # released indexes
+        self.pred = np.full((capacity, capacity), NO_SWITCH, dtype=np.int32)
+        self.dist = np.full((capacity, capacity), np.inf, dtype=np.float32)
+        self.ports = np.full((capacity, capacity), NO_PORT, dtype=np.int32)
+        self.valid = np.zeros(capacity, dtype=bool) # tree i is up to date with the current topology
+        self.tree_version = np.zeros(capacity, dtype=np.int64) # bumped when a tree is recomputed
+        self.cache = OrderedDict() # self.cache[(s1, s2)] = (tree version, path)
+        self.cache_size = cache_size
+        self.k_paths = {} # self.k_paths[(s1, s2, k)] = (version, k shortest paths)
+
+    def __getitem__(self, src):
+        return RoutingRow(self, src)
+
+    def __contains__(self, src):
+        return src in self.index
+
+    def __bool__(self):
+        return bool(self.index)
+    __nonzero__ = __bool__
+
+    @property
+    def nodes(self):
+        return list(self.index)
+
+    # Grow the matrices when more switches join than they can hold
+    def grow(self):
+        old = len(self.valid)
+        new = old * 2
+        for name, fill in (('pred', NO_SWITCH), ('dist', np.inf), ('ports', NO_PORT)):
+            matrix = getattr(self, name)
+            bigger = np.full((new, new), fill, dtype=matrix.dtype)
+            bigger[:old, :old] = matrix
+            setattr(self, name, bigger)
+        self.valid = np.concatenate([self.valid, np.zeros(old, dtype=bool)])
+        self.tree_version = np.concatenate([self.tree_version, np.zeros(old, dtype=np.int64)])
+
+    # Path from src to dst as a list of switch IDs, [] if unreachable
+    def path(self, src, dst):
+        if src not in self.index or dst not in self.index:
+            return []
+        i = self.index[src]
+        if not self.valid[i]:
+            self.update_tree(src)
+        key = (src, dst)
+        entry = self.cache.get(key)
+        if entry is not None and entry[0] == self.tree_version[i]:
+            self.cache.move_to_end(key)
+            return entry[1]
+        path = self.build_path(i, self.index[dst])
+        self.cache[key] = (self.tree_version[i], path)
+        self.cache.move_to_end(key)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return path
+
+    # Walk the predecessor row of tree i back from switch j
+    def build_path(self, i, j):
+        if i == j:
+            return [self.dpids[i]]
+        pred = self.pred[i]
+        if pred[j] == NO_SWITCH:
+            return []
+        path = [self.dpids[j]]
+        while j != i:
+            j = pred[j]
+            path.append(self.dpids[j])
+        return path[::-1]
+
+    # (switch, next hop towards root) for every switch that reaches root, read from the
+    # tree rooted at root (links are bidirectional, so tree parents lead back to the root)
+    def next_hops(self, root):
+        if root not in self.index:
+            return []
+        i = self.index[root]
+        if not self.valid[i]:
+            self.update_tree(root)
+        pred = self.pred[i]
+        return [(self.dpids[j], self.dpids[pred[j]]) for j in np.flatnonzero(pred != NO_SWITCH)]
+
+    # Port of s1 that links to s2
+    def out_port(self, s1, s2):
+        return int(self.ports[self.index[s1], self.index[s2]])
+
+    # Out port of every switch in the path from src to dst but the last one
+    def path_ports(self, src, dst):
+        path = self.path(src, dst)
+        return [self.out_port(s1, s2) for s1, s2 in zip(path[:-1], path[1:])]
+
+    # Up to k shortest paths from src to dst by increasing cost, the first one read from
+    # the tree of src. Kept until the next topology or weight change
+    def k_shortest_paths(self, src, dst, k):
+        key = (src, dst, k)
+        entry = self.k_paths.get(key)
+        if entry is not None and entry[0] == self.version:
+            return entry[1]
+        first = self.path(src, dst)
+        paths = k_shortest_paths(self.adjacency, src, dst, k, self.weights, self.index, first) if first else []
+        self.k_paths[key] = (self.version, paths)
+        return paths
+
+    # Topology snapshot for compute_trees: (version, links, weights) over the matrix indexes
+    def snapshot(self):
+        n = len(self.dpids)
+        links = self.ports[:n, :n] != NO_PORT
+        weights = None
+        if self.weights is not None:
+            weights = np.ones((n, n), dtype=np.float32)
+            for s1, row in self.weights.items():
+                for s2, w in row.items():
+                    if s1 in self.index and s2 in self.index:
+                        weights[self.index[s1], self.index[s2]] = w
+        return self.version, links, weights
+
+    # Swap in trees computed from a snapshot of the given version, dropped if the
+    # topology changed in the meantime. Returns True if they were applied
+    def apply_trees(self, version, sources, pred, dist):
+        if version != self.version:
+            return False
+        rows = np.asarray(sources)
+        n = pred.shape[1]
+        self.pred[rows, :] = NO_SWITCH
+        self.dist[rows, :] = np.inf
+        self.pred[rows, :n] = pred
+        self.dist[rows, :n] = dist
+        self.valid[rows] = True
+        self.tree_version[rows] += 1
+        return True
+
+    # Recompute the trees of the given sources (all switches by default) in the workers of
+    # executor (e.g. a ProcessPoolExecutor), one chunk of sources per worker (as many as
+    # the CPUs by default, like ProcessPoolExecutor), waiting with sleep so the caller's
+    # event loop keeps running. Retries when the topology changes before the results are back
+    def recompute_in_executor(self, executor, sleep, sources=None, poll=0.01, workers=None):
+        workers = workers or os.cpu_count() or 1
+        while True:
+            if sources is None:
+                rows = [self.index[dpid] for dpid in self.nodes]
+            else:
+                rows = [self.index[dpid] for dpid in sources if dpid in self.index]
+            if not rows:
+                return
+            version, links, weights = self.snapshot()
+            chunks = [chunk.tolist() for chunk in np.array_split(rows, min(workers, len(rows)))]
+            futures = [executor.submit(compute_trees, links, chunk, weights) for chunk in chunks]
+            while not all(future.done() for future in futures):
+                sleep(poll)
+            results = [future.result() for future in futures]
+            pred = np.concatenate([result[0] for result in results])
+            dist = np.concatenate([result[1] for result in results])
+            if self.apply_trees(version, rows, pred, dist):
+                return
+
+    # Compute the trees of the given sources now (e.g. known ingress switches),
+    # so later lookups from them never wait
+    def warm_up(self, sources):
+        for src in sources:
+            if src in self.index and not self.valid[self.index[src]]:
+                self.update_tree(src)
+
+    # Recompute the tree rooted at src
+    def update_tree(self, src):
+        i = self.index[src]
+        pred, dist = shortest_path_tree(self.adjacency, src, self.weights, self.index)
+        self.pred[i, :] = NO_SWITCH
+        self.dist[i, :] = np.inf
+        for node, prev in pred.items():
+            j = self.index[node]
+            self.dist[i, j] = dist[node]
+            if prev is not None:
+                self.pred[i, j] = self.index[prev]
+        self.valid[i] = True
+        self.tree_version[i] += 1
+
+    # Mark the given trees out of date, they are recomputed on their next lookup.
+    # Returns the sources whose paths may have changed
+    def invalidate(self, sources):
+        for src in sources:
+            i = self.index[src]
+            self.valid[i] = False
+            self.tree_version[i] += 1
+        return sources
+
+    # Sources of the up to date trees whose rows match the boolean mask
+    def sources(self, mask):
+        mask = mask & self.valid
+        return [self.dpids[i] for i in np.flatnonzero(mask)]
+
+    def link_weight(self, s1, s2):
+        if self.weights is None:
+            return 1
+        return self.weights.get(s1, {}).get(s2, 1)
+
+    # Change the cost of the link s1-s2 (from s1 to s2), only the trees it can shorten
+    # or that use it are invalidated. Returns the sources whose paths may have changed
+    def set_link_weight(self, s1, s2, weight):
+        old = self.link_weight(s1, s2)
+        if weight == old:
+            return []
+        if self.weights is None:
+            self.weights = defaultdict(dict)
+        self.weights.setdefault(s1, {})[s2] = weight
+        self.version += 1
+        if s1 not in self.index or s2 not in self.index:
+            return []
+        i, j = self.index[s1], self.index[s2]
+        if self.ports[i, j] == NO_PORT:
+            return []
+        if weight < old:
+            mask = self.dist[:, i] + weight < self.dist[:, j]
+        else:
+            mask = self.pred[:, j] == i
+        return self.invalidate(self.sources(mask))
+
+    def add_switch(self, dpid):
+        if dpid in self.index:
+            return []
+        self.version += 1
+        if self.free:
+            i = self.free.pop()
+            self.dpids[i] = dpid
+        else:
+            i = len(self.dpids)
+            if i == len(self.valid):
+                self.grow()
+            self.dpids.append(dpid)
+        self.index[dpid] = i
+        # links of the switch may have been seen before the switch itself
+        mask = np.zeros(len(self.valid), dtype=bool)
+        for next in self.adjacency[dpid]:
+            if next in self.index:
+                mask |= self.shortened_trees(dpid, next)
+        return self.invalidate(self.sources(mask) + [dpid])
+
+    def remove_switch(self, dpid):
+        if dpid not in self.index:
+            return []
+        self.version += 1
+        i = self.index.pop(dpid)
+        for key in [key for key in self.cache if dpid in key]:
+            del self.cache[key]
+        affected = self.sources(self.pred[:, i] != NO_SWITCH)
+        for matrix, fill in ((self.pred, NO_SWITCH), (self.dist, np.inf), (self.ports, NO_PORT)):
+            matrix[i, :] = fill
+            matrix[:, i] = fill
+        self.valid[i] = False
+        self.tree_version[i] += 1
+        self.dpids[i] = None
+        self.free.append(i)
+        return self.invalidate([src for src in affected if src != dpid])
+
+    # Call after the link s1-s2 has been added to adjacency,
+    # only trees that the new link shortens are invalidated. The trees of s1 and s2 are
+    # returned too when they were not computed yet (e.g. a switch that just connected),
+    # their paths have never been reported since
+    def link_added(self, s1, s2):
+        self.version += 1
+        if s1 not in self.index or s2 not in self.index:
+            return []
+        pending = [src for src in (s1, s2) if not self.valid[self.index[src]]]
+        return self.invalidate(self.sources(self.shortened_trees(s1, s2)) + pending)
+
+    # Record the ports of link s1-s2, returns the mask of trees it shortens
+    def shortened_trees(self, s1, s2):
+        i, j = self.index[s1], self.index[s2]
+        self.ports[i, j] = self.adjacency[s1].get(s2, NO_PORT)
+        self.ports[j, i] = self.adjacency[s2].get(s1, NO_PORT)
+        mask = np.zeros(len(self.valid), dtype=bool)
+        if self.ports[i, j] != NO_PORT:
+            mask |= self.dist[:, i] + self.link_weight(s1, s2) < self.dist[:, j]
+        if self.ports[j, i] != NO_PORT:
+            mask |= self.dist[:, j] + self.link_weight(s2, s1) < self.dist[:, i]
+        return mask
+
+    # Call after the link s1-s2 has been deleted from adjacency,
+    # only trees that used the link are invalidated
+    def link_deleted(self, s1, s2):
+        self.version += 1
+        if s1 not in self.index or s2 not in self.index:
+            return []
+        i, j = self.index[s1], self.index[s2]
+        self.ports[i, j] = self.adjacency[s1].get(s2, NO_PORT)
+        self.ports[j, i] = self.adjacency[s2].get(s1, NO_PORT)
+        mask = (self.pred[:, j] == i) | (self.pred[:, i] == j)
+        return self.invalidate(self.sources(mask))
+
+# routing_table[s1] view, routing_table[s1][s2] is the path from s1 to s2
+class RoutingRow(object):
+    def __init__(self, table, src):
+        self.table = table
+        self.src = src
+
+    def __getitem__(self, dst):
+        return self.table.path(self.src, dst)
+
+    def __contains__(self, dst):
+        return dst in self.table.index and dst != self.src
+
+    def __iter__(self):
+        return (dst for dst in self.table.nodes if dst != self.src)
@@ -20,8 +20,21 @@ from ryu.topology import event
 
 from collections import defaultdict
 
+from paths import *
+
 import time
 
+# Install destination-based rules (one per destination host per switch, matching only
+# ipv4_dst/arp_tpa) from the shortest path trees, instead of exact-match rules for every
+# host pair on every path. enode_select.py measures the loss from the counters of its own
+# outbound rules and the port stats, so the host-pair rules are only needed to count the
+# traffic of every host pair
+AGGREGATE_ROUTES = True
+
+# Topology changes touching at least this many trees are recomputed in the worker
+# processes, so the event loop keeps handling packet-ins and stats replies meanwhile
+OFFLOAD_MIN_TREES = 16
+
 class simple_routing(app_manager.RyuApp):
     OFP_VERSIONS = [ofproto_v1_3.OFP_VERSION]
 
@@ -32,71 +45,76 @@ class simple_routing(app_manager.RyuApp):
         self.datapaths = {} #list of IDs or DATAPATHs of switches in the network
         self.switches = [] #list of switch ENTITIES
         self.adjacency = defaultdict(dict) # self.adjacency[s1][s2] = port of switch s1 that links to switch s2
-        self.routing_table = defaultdict(dict) #self.routing_table[s1][s2] contains switchs in the shortest path from s1 to s2
+        self.routing_table = RoutingTable(self.adjacency) #self.routing_table[s1][s2] contains switchs in the shortest path from s1 to s2
+        self.installed = False # True once the initial paths are installed, later changes are reinstalled per source
+        self.installed_ports = defaultdict(dict) # self.installed_ports[switch][dst] = out port of the installed destination rules
+        self.pending_sources = {} # sources whose paths wait to be reinstalled, in the order of the events (values unused)
+        self.reinstalling = False # True while a green thread reinstalls the pending sources
+        self.routing_pool = routing_executor() # worker processes for large routing table computations
     
     # Main thread
     def main_routing(self):
         while True:
             hub.sleep(1)
-            self.calculate_routing_table()
             if self.routing_table:
-                for i in range(0,len(self.switches) - 1):
-                    for j in range (i + 1, len(self.switches)):
-                        src = self.switches[i].id
-                        dst = self.switches[j].id
-                        self.install_path(src,dst)
-                        self.install_path(dst,src)
+                self.calculate_routing_table()
+                if AGGREGATE_ROUTES:
+                    self.install_destinations([sw.id for sw in self.switches])
+                else:
+                    for i in range(0,len(self.switches) - 1):
+                        for j in range (i + 1, len(self.switches)):
+                            src = self.switches[i].id
+                            dst = self.switches[j].id
+                            self.install_path(src,dst)
+                            self.install_path(dst,src)
+                self.installed = True
                 break
             else:
                 hub.sleep(4)
     
-    # Get all possible path between src and dst switch
-    def get_paths(self, src, dst):
-        if src == dst:
-            # host target is on the same switch
-            return [[src]]
-        paths = []
-        stack = [(src, [src])]
-        while stack:
-            (node, path) = stack.pop()
-            for next in set(self.adjacency[node].keys()) - set(path):
-                if next is dst:
-                    paths.append(path + [next])
-                else:
-                    stack.append((next, path + [next]))
-        return paths
-    
-    # Get shortest path from src to dst sw
-    def get_shortest_path(self, src, dst):
-        paths = self.get_paths(src, dst)
-        if not paths:
-            return paths
-        min = len(paths[0]) + 1
-        shortest_path = []
-        for path in paths:
-            if len(path) < min:
-                shortest_path = path
-                min = len(path)
-        return shortest_path
-
-    # Calculate routing table with shortest path rule
+    # Calculate routing table with shortest path rule (one BFS tree per switch),
+    # in the worker processes while this green thread waits
     def calculate_routing_table(self):
         start_time = time.time()
-        for i in range(0,len(self.switches) - 1):
-            for j in range (i + 1, len(self.switches)):
-                src = self.switches[i].id
-                dst = self.switches[j].id
-                path = self.get_shortest_path(src,dst)
-                self.routing_table[src][dst] = path
-                self.routing_table[dst][src] = path[::-1]
+        self.routing_table.recompute_in_executor(self.routing_pool, hub.sleep)
         elapsed_time = time.time() - start_time
+
+    # Reinstall the paths of sources whose tree changed after a topology event,
+    # from a green thread so that the event handlers return at once. Sources of the
+    # events that arrive while it runs are merged into a single pending recompute
+    def reinstall_paths(self, sources):
+        if not self.installed or not sources:
+            return
+        self.pending_sources.update(dict.fromkeys(sources))
+        if not self.reinstalling:
+            self.reinstalling = True
+            hub.spawn(self.reinstall_pending)
+
+    def reinstall_pending(self):
+        try:
+            while self.pending_sources:
+                sources = list(self.pending_sources)
+                self.pending_sources.clear()
+                self.recompute_and_install(sources)
+        finally:
+            self.reinstalling = False
+
+    def recompute_and_install(self, sources):
+        if len(sources) >= OFFLOAD_MIN_TREES:
+            self.routing_table.recompute_in_executor(self.routing_pool, hub.sleep, sources)
+        if AGGREGATE_ROUTES:
+            # trees are symmetric, the tree rooted at a destination gives its rules
+            self.install_destinations([dst for dst in sources if dst in self.datapaths])
+            return
+        for src in sources:
+            for dst in self.routing_table[src]:
+                if src in self.datapaths and dst in self.datapaths:
+                    self.install_path(src, dst)
     
     # install routing rules in defined path between src and dst switch
     def install_path(self, src, dst):
         path = self.routing_table[src][dst]
-        ports = [] #outport for each switch in the path
-        for s1, s2 in zip(path[:-1], path[1:]):
-            ports.append(self.adjacency[s1][s2])
+        ports = self.routing_table.path_ports(src, dst) #outport for each switch in the path
         ports.append(1)
         
         for i in range(len(path)):
@@ -109,19 +127,49 @@ class simple_routing(app_manager.RyuApp):
 
             match_ip = ofp_parser.OFPMatch(
                 eth_type=0x0800,
-                ipv4_src = '10.0.0.' + str(src),
-                ipv4_dst = '10.0.0.' + str(dst)
+                ipv4_src = host_ip(src),
+                ipv4_dst = host_ip(dst)
             )
             match_arp = ofp_parser.OFPMatch(
                 eth_type=0x0806, 
-                arp_spa='10.0.0.' + str(src), 
-                arp_tpa='10.0.0.' + str(dst)
+                arp_spa=host_ip(src), 
+                arp_tpa=host_ip(dst)
             )
 
             action = [ofp_parser.OFPActionOutput(out_port)]
             self.add_flow(dp, 65535, match_ip, action)
             self.add_flow(dp, 65535, match_arp, action)
 
+    # install destination-based rules towards every switch in dsts, one per destination and switch.
+    # Only rules whose out port changed are sent, the matches of a destination are built once,
+    # flow mods are batched per switch and each batch ends with a barrier
+    def install_destinations(self, dsts):
+        batches = defaultdict(list) # batches[switch] = (dst, out_port) rules to install on switch
+        for dst in dsts:
+            batches[dst].append((dst, 1))
+            for switch, next in self.routing_table.next_hops(dst):
+                batches[switch].append((dst, self.routing_table.out_port(switch, next)))
+
+        matches = {} # matches[dst] = (ipv4 match, arp match) of the rules towards dst
+        for switch, rules in batches.items():
+            if switch not in self.datapaths:
+                continue
+            dp = self.datapaths[switch]
+            ofp_parser = dp.ofproto_parser
+            installed = self.installed_ports[switch]
+            rules = [(dst, out_port) for dst, out_port in rules if installed.get(dst) != out_port]
+            if not rules:
+                continue
+            for dst, out_port in rules:
+                if dst not in matches:
+                    matches[dst] = (ofp_parser.OFPMatch(eth_type=0x0800, ipv4_dst = host_ip(dst)),
+                                    ofp_parser.OFPMatch(eth_type=0x0806, arp_tpa=host_ip(dst)))
+                action = [ofp_parser.OFPActionOutput(out_port)]
+                self.add_flow(dp, 65535, matches[dst][0], action)
+                self.add_flow(dp, 65535, matches[dst][1], action)
+                installed[dst] = out_port
+            dp.send_msg(ofp_parser.OFPBarrierRequest(dp))
+
     # Install a flow to a specific switch
     def add_flow(self, datapath, priority, match, actions):
         ofproto = datapath.ofproto
@@ -141,11 +189,14 @@ class simple_routing(app_manager.RyuApp):
                 self.logger.info('A switch connect - dpid: %016x', datapath.id)
                 self.switches.append(datapath)
                 self.datapaths[datapath.id] = datapath
+                self.installed_ports.pop(datapath.id, None) # a reconnected switch starts with an empty table
+                self.reinstall_paths(self.routing_table.add_switch(datapath.id))
         elif ev.state == DEAD_DISPATCHER:
             if datapath.id in self.datapaths:
                 self.logger.info('A switch has just disconnected - dpid: %016x', datapath.id)
                 del self.datapaths[datapath.id]
                 self.switches.remove(datapath)
+                self.reinstall_paths(self.routing_table.remove_switch(datapath.id))
 
     @set_ev_cls(event.EventLinkAdd, MAIN_DISPATCHER)
     def link_add_handler(self, ev):
@@ -154,6 +205,7 @@ class simple_routing(app_manager.RyuApp):
         self.adjacency[s1.dpid][s2.dpid] = s1.port_no
         self.adjacency[s2.dpid][s1.dpid] = s2.port_no
         # self.logger.info(self.adjacency)
+        self.reinstall_paths(self.routing_table.link_added(s1.dpid, s2.dpid))
 
     @set_ev_cls(event.EventLinkDelete, MAIN_DISPATCHER)
     def link_delete_handler(self, ev):
@@ -165,4 +217,5 @@ class simple_routing(app_manager.RyuApp):
             del self.adjacency[s2.dpid][s1.dpid]
         except KeyError:
             pass
+        self.reinstall_paths(self.routing_table.link_deleted(s1.dpid, s2.dpid))
 
@@ -0,0 +1,60 @@
+# This is a part of the program in the article:
+#  "A Reinforcement Learning-Based Solution for Intra-Domain Egress Selection"
+#  Authors: Duc-Huy LE, Hai Anh TRAN, Sami SOUIHI
+#  Conference: HPSR2021
+
+# This is a library keeping time series of switch statistics (flow, port and
+# aggregate counters) in fixed-size NumPy ring buffers, one row per key
+# (e.g. (dpid, port_no)), so that any time window can be read from memory.
+
+import numpy as np
+
+class RingBuffer(object):
+    def __init__(self, size, fields, rows=16):
+        self.size = size # samples kept per key
+        self.fields = fields # names of the values of a sample
+        self.index = {} # self.index[key] = row of the key
+        self.times = np.full((rows, size), np.nan)
+        self.values = np.zeros((rows, size, len(fields)))
+        self.count = np.zeros(rows, dtype=np.int64) # samples ever written per row
+
+    # Row of a key, allocated (and the buffers grown) on first use
+    def row(self, key):
+        r = self.index.get(key)
+        if r is None:
+            r = len(self.index)
+            if r == len(self.count):
+                self.grow()
+            self.index[key] = r
+        return r
+
+    def grow(self):
+        rows = len(self.count)
+        self.times = np.concatenate([self.times, np.full((rows, self.size), np.nan)])
+        self.values = np.concatenate([self.values, np.zeros((rows, self.size, len(self.fields)))])
+        self.count = np.concatenate([self.count, np.zeros(rows, dtype=np.int64)])
+
+    # Append one sample taken at time t for every key, values[k] belongs to keys[k]
+    def append(self, keys, t, values):
+        if not keys:
+            return
+        rows = np.array([self.row(key) for key in keys])
+        pos = self.count[rows] % self.size
+        self.times[rows, pos] = t
+        self.values[rows, pos] = values
+        self.count[rows] += 1
+
+    # Samples of a key taken between t0 and t1, oldest first, as (times, values) arrays
+    def window(self, key, t0, t1):
+        r = self.index.get(key)
+        if r is None:
+            return np.empty(0), np.empty((0, len(self.fields)))
+        n = min(self.count[r], self.size)
+        order = (self.count[r] - n + np.arange(n)) % self.size
+        times = self.times[r, order]
+        mask = (times >= t0) & (times <= t1)
+        return times[mask], self.values[r, order][mask]
+
+    # Column of a field in the values
+    def field(self, name):
+        return self.fields.index(name)
@@ -0,0 +1,835 @@
+# This is a part of the program in the article:
+#  "A Reinforcement Learning-Based Solution for Intra-Domain Egress Selection"
+#  Authors: Duc-Huy LE, Hai Anh TRAN, Sami SOUIHI
+#  Conference: HPSR2021
+
+# This is an in-process stand-in for the mininet testbed, to load test the ryu applications
+# at a scale mininet cannot reach. Every switch is a fake OpenFlow 1.3 datapath keeping its
+# flow and group tables and its flow/port counters, links have a delay and a loss rate (like
+# netem) and can go down, and the apps are run in the same process under a virtual clock:
+# time.time/monotonic and the eventlet timers (hub.sleep, timeouts) jump from one event to
+# the next, so large networks can be emulated for hours of virtual time. The rules the apps
+# install bound the scale: enode_select alone runs on thousands of switches, routing with
+# AGGREGATE_ROUTES (the default) on about a thousand, with exact-match rules on a few hundred.
+#
+# The apps receive the same events as with ryu-manager --observe-links (switch connections,
+# link add/delete, OpenFlow replies and packet-ins), the emulator answering their flow mods,
+# group mods, packet outs, barriers, echoes and flow/port/aggregate statistics requests.
+# Traffic is carried in batches of packets (one batch per flow and tick) rather than packet
+# by packet, and the controller work itself takes no virtual time. Select groups hash the
+# header fields of a flow to one bucket like OVS, so a single flow (e.g. the --outbound
+# traffic) is never split over several buckets.
+#
+# Run it from the ryu-apps directory, e.g.:
+#   python ../testbed/emulator/emulator.py --topology bso --apps routing enode_select --duration 600 \
+#       --traffic 1-4:100 1-6:100 --link 2-7:10:0.02 --event 300:down:2-7
+#   python ../testbed/emulator/emulator.py --topology random --switches 1000 --apps routing --duration 60
+
+import argparse
+import ast
+import functools
+import importlib
+import inspect
+import logging
+import os
+import sys
+import time
+import zlib
+from collections import Counter, deque, namedtuple
+from concurrent.futures import Future
+
+import eventlet.hubs
+from eventlet.hubs import poll
+import numpy as np
+
+from ryu.base import app_manager
+from ryu.controller import ofp_event
+from ryu.controller.handler import MAIN_DISPATCHER, DEAD_DISPATCHER, register_instance
+from ryu.lib import addrconv
+from ryu.lib import hub
+from ryu.ofproto import ofproto_v1_3, ofproto_v1_3_parser
+from ryu.topology import event
+from ryu.topology.switches import Link
+
+# Directory of the ryu applications (they import mab, paths and stats from it)
+APPS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'ryu-apps')
+sys.path.insert(0, os.path.abspath(APPS_DIR))
+
+from paths import host_ip
+
+# Port of every switch attached to its host (h_i - s_i), as in bso.py and funet.py.
+# Links to other switches take the next ports, in the order the links are added
+HOST_PORT = 1
+
+# Defaults of the links (seconds, ratio) and of the controller-switch channel (seconds, one way)
+LINK_DELAY = 0.001
+LINK_LOSS = 0.0
+CONTROL_DELAY = 0.001
+
+# Header fields a select group hashes to choose the bucket of a flow
+FLOW_HASH_FIELDS = ('eth_src', 'eth_dst', 'eth_type', 'ipv4_src', 'ipv4_dst')
+
+# Seconds between the connection of the switches and the discovery of the links,
+# and between a link going down and its deletion being reported
+DISCOVERY_DELAY = 1
+PORT_STATUS_DELAY = 0.001
+
+# Entries per part of a multipart flow stats reply
+MULTIPART_ENTRIES = 100
+
+# Hops after which a packet is dropped, so that forwarding loops end
+MAX_HOPS = 64
+
+# Link lists of the topologies of testbed/mininet (switch i has host host_ip(i), 10.0.0.i)
+TOPOLOGIES = {
+    'bso': list(zip([1,2,2,2,2,2,3,3,5,7,8,8,9,9,10,11,12,13],
+                    [2,3,4,5,7,8,4,5,6,9,9,12,10,13,11,13,13,14])),
+    'funet': list(zip([1,1,1,2,3,3,4,5,6,6,7,7,9,10,11,12,13,14,15,16,17,18,19,20,21,22,23],
+                      [3,21,23,23,4,6,5,7,7,10,8,9,13,11,12,13,14,15,16,17,18,19,20,21,22,23,24])),
+}
+
+# Ends of a link in the topology events, like the ryu.topology Port the apps read
+Endpoint = namedtuple('Endpoint', ['dpid', 'port_no'])
+
+# Virtual time, advanced by the hub when every green thread is waiting.
+# install() makes time.time, time.monotonic and time.monotonic_ns read it
+class VirtualClock(object):
+    def __init__(self, start=0.0):
+        self.now = start
+        self.epoch = time.time() # wall clock time of the virtual time 0
+        self.saved = {}
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        if seconds and seconds > 0:
+            self.now += seconds
+
+    def time(self):
+        return self.epoch + self.now
+
+    def monotonic_ns(self):
+        return int(round(self.now * 1e9))
+
+    def install(self):
+        for name in ('time', 'monotonic', 'monotonic_ns'):
+            self.saved[name] = getattr(time, name)
+        time.time = self.time
+        time.monotonic = self
+        time.monotonic_ns = self.monotonic_ns
+
+    def uninstall(self):
+        for name, func in self.saved.items():
+            setattr(time, name, func)
+        self.saved = {}
+
+CLOCK = VirtualClock()
+
+# Eventlet hub on the virtual clock: instead of sleeping until its next timer, it moves the
+# clock forward to it. Sockets, if any, are still polled (without blocking)
+class VirtualHub(poll.Hub):
+    def __init__(self, clock=None):
+        super(VirtualHub, self).__init__(CLOCK if clock is None else clock)
+
+    @staticmethod
+    def is_available():
+        return True
+
+    def wait(self, seconds=None):
+        if self.listeners[self.READ] or self.listeners[self.WRITE]:
+            super(VirtualHub, self).wait(0)
+        self.clock.advance(seconds)
+
+# Runs the jobs the apps hand to their routing process pool at once, in the calling thread
+class InlineExecutor(object):
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        future.set_result(fn(*args, **kwargs))
+        return future
+
+    def shutdown(self, wait=True):
+        pass
+
+# Canonical text of a match or header value, so that 'ff:ff:ff:ff:ff:1' in a match equals
+# 'ff:ff:ff:ff:ff:01' read from a frame. Values that are not addresses are kept as they are.
+# Cached, the same few addresses are in most flow mods
+@functools.lru_cache(maxsize=1 << 16)
+def normalize(field, value):
+    try:
+        if field in ('eth_src', 'eth_dst'):
+            return addrconv.mac.bin_to_text(addrconv.mac.text_to_bin(value))
+        if field in ('ipv4_src', 'ipv4_dst', 'arp_spa', 'arp_tpa'):
+            return addrconv.ipv4.bin_to_text(addrconv.ipv4.text_to_bin(value))
+    except Exception:
+        pass
+    return value
+
+# Batch of count identical packets of size bytes, fields are the header fields matched by
+# the flow tables. data is the frame of packets sent by packet outs, handed back in packet-ins
+class Packet(object):
+    def __init__(self, fields, count=1, size=64, data=None, hops=0):
+        self.fields = fields
+        self.count = count
+        self.size = size
+        self.data = data
+        self.hops = hops
+
+    def copy(self, count=None):
+        return Packet(dict(self.fields), self.count if count is None else count, self.size, self.data, self.hops)
+
+    # Header fields of an ethernet frame (an IPv4 header is read too)
+    @staticmethod
+    def parse(data):
+        data = bytes(data)
+        fields = {'eth_dst': addrconv.mac.bin_to_text(data[0:6]),
+                  'eth_src': addrconv.mac.bin_to_text(data[6:12]),
+                  'eth_type': int.from_bytes(data[12:14], 'big')}
+        if fields['eth_type'] == 0x0800 and len(data) >= 34:
+            fields['ipv4_src'] = addrconv.ipv4.bin_to_text(data[26:30])
+            fields['ipv4_dst'] = addrconv.ipv4.bin_to_text(data[30:34])
+        return Packet(fields, size=len(data), data=data)
+
+    # Frame of a packet sent to the controller when it was not built by a packet out
+    def frame(self):
+        if self.data is not None:
+            return self.data
+        header = b''
+        for field in ('eth_dst', 'eth_src'):
+            try:
+                header += addrconv.mac.text_to_bin(self.fields.get(field, '00:00:00:00:00:00'))
+            except Exception:
+                header += bytes(6)
+        header += int(self.fields.get('eth_type', 0)).to_bytes(2, 'big')
+        return header + bytes(max(0, self.size - len(header)))
+
+class FlowEntry(object):
+    def __init__(self, msg, now):
+        self.match = msg.match # OFPMatch of the flow mod, returned in flow stats
+        self.fields = dict((field, normalize(field, value)) for field, value in msg.match.items())
+        self.priority = msg.priority
+        self.cookie = msg.cookie
+        self.instructions = msg.instructions
+        self.actions = []
+        for inst in msg.instructions:
+            if isinstance(inst, ofproto_v1_3_parser.OFPInstructionActions) and inst.type == ofproto_v1_3.OFPIT_APPLY_ACTIONS:
+                self.actions.extend(inst.actions)
+        self.packet_count = 0
+        self.byte_count = 0
+        self.install_time = now
+
+    # Non-strict match of a delete or a statistics request: every field of fields is in the entry
+    def covered_by(self, fields, cookie, cookie_mask):
+        if (self.cookie & cookie_mask) != (cookie & cookie_mask):
+            return False
+        for field, value in fields.items():
+            if self.fields.get(field) != value:
+                return False
+        return True
+
+# Flow table of a switch. Entries are grouped by priority and matched fields, so a lookup is
+# one dict access per group (exact matches only, the apps do not use masks)
+class FlowTable(object):
+    def __init__(self):
+        self.groups = {} # self.groups[(priority, fields)] = {values of the fields: entry}
+        self.order = [] # keys of self.groups, highest priority first
+        self.count = 0
+
+    def key(self, entry):
+        names = tuple(sorted(entry.fields))
+        return (entry.priority, names), tuple(entry.fields[name] for name in names)
+
+    # Add an entry, replacing the one with the same priority and match (its counters are kept)
+    def add(self, entry):
+        key, values = self.key(entry)
+        group = self.groups.get(key)
+        if group is None:
+            group = self.groups[key] = {}
+            self.order.append(key)
+            self.order.sort(key=lambda k: -k[0])
+        old = group.get(values)
+        if old is None:
+            self.count += 1
+        else:
+            entry.packet_count = old.packet_count
+            entry.byte_count = old.byte_count
+        group[values] = entry
+
+    # Highest priority entry matching the fields of a packet, None on a table miss
+    def lookup(self, fields):
+        for key in self.order:
+            entry = self.groups[key].get(tuple(fields.get(name) for name in key[1]))
+            if entry is not None:
+                return entry
+        return None
+
+    # Delete the entries covered by fields and the cookie, returns how many were deleted
+    def delete(self, fields, cookie=0, cookie_mask=0):
+        deleted = 0
+        for key in list(self.order):
+            group = self.groups[key]
+            for values, entry in list(group.items()):
+                if entry.covered_by(fields, cookie, cookie_mask):
+                    del group[values]
+                    deleted += 1
+            if not group:
+                del self.groups[key]
+                self.order.remove(key)
+        self.count -= deleted
+        return deleted
+
+    def entries(self, fields=None, cookie=0, cookie_mask=0):
+        for key in self.order:
+            for entry in self.groups[key].values():
+                if fields is None or entry.covered_by(fields, cookie, cookie_mask):
+                    yield entry
+
+    def __len__(self):
+        return self.count
+
+# Counters of a switch port
+class PortState(object):
+    def __init__(self, port_no, link, now):
+        self.port_no = port_no
+        self.link = link # EmulatedLink of the port, None for the host port
+        self.rx_packets = 0
+        self.tx_packets = 0
+        self.rx_bytes = 0
+        self.tx_bytes = 0
+        self.rx_dropped = 0
+        self.tx_dropped = 0
+        self.start_time = now
+
+    def live(self):
+        return self.link is None or self.link.up
+
+# Link between two switch ports, with a one-way delay (seconds) and a loss rate per direction
+class EmulatedLink(object):
+    def __init__(self, s1, p1, s2, p2, delay=LINK_DELAY, loss=LINK_LOSS):
+        self.ends = (Endpoint(s1, p1), Endpoint(s2, p2))
+        self.delay = delay
+        self.loss = loss
+        self.up = True
+
+    def peer(self, dpid):
+        if self.ends[0].dpid == dpid:
+            return self.ends[1]
+        return self.ends[0]
+
+# Fake OpenFlow 1.3 switch, standing for ryu.controller.controller.Datapath in the apps.
+# Messages are handled in the order they were sent, CONTROL_DELAY after being sent
+class Datapath(object):
+    def __init__(self, network, dpid, control_delay=CONTROL_DELAY):
+        self.network = network
+        self.id = dpid
+        self.ofproto = ofproto_v1_3
+        self.ofproto_parser = ofproto_v1_3_parser
+        self.xid = 0
+        self.is_active = True
+        self.control_delay = control_delay
+        self.table = FlowTable()
+        self.groups = {} # self.groups[group_id] = OFPGroupMod that added the group
+        self.ports = {HOST_PORT: PortState(HOST_PORT, None, CLOCK())}
+        self.inbox = deque() # (time due, message) of the messages sent by the controller, not handled yet
+        self.received = Counter() # messages handled, by type
+        self.table_misses = 0
+
+    def set_xid(self, msg):
+        self.xid += 1
+        self.xid &= self.ofproto.MAX_XID
+        msg.set_xid(self.xid)
+        return self.xid
+
+    def send_msg(self, msg):
+        if not self.is_active:
+            return False
+        if msg.xid is None:
+            self.set_xid(msg)
+        self.inbox.append((CLOCK() + self.control_delay, msg))
+        if len(self.inbox) == 1:
+            self.network.schedule(self.control_delay, self.handle_inbox)
+        return True
+
+    # Handle the messages that are due in the order they were sent (one timer per switch:
+    # timers of equal deadlines fire in any order), then wait for the next one
+    def handle_inbox(self):
+        now = CLOCK() + 1e-9
+        while self.inbox and self.inbox[0][0] <= now and self.is_active:
+            msg = self.inbox.popleft()[1]
+            name = msg.__class__.__name__
+            self.received[name] += 1
+            handler = getattr(self, 'handle_' + name, None)
+            if handler is not None:
+                handler(msg)
+        if self.inbox and self.is_active:
+            self.network.schedule(self.inbox[0][0] - CLOCK(), self.handle_inbox)
+
+    # Send a reply or an asynchronous message to the controller
+    def reply(self, msg, request=None):
+        if request is not None:
+            msg.set_xid(request.xid)
+        self.network.schedule(self.control_delay, self.network.deliver, msg)
+
+    def handle_OFPFlowMod(self, msg):
+        ofp = self.ofproto
+        if msg.command in (ofp.OFPFC_ADD, ofp.OFPFC_MODIFY, ofp.OFPFC_MODIFY_STRICT):
+            self.table.add(FlowEntry(msg, CLOCK()))
+        elif msg.command in (ofp.OFPFC_DELETE, ofp.OFPFC_DELETE_STRICT):
+            fields = dict((field, normalize(field, value)) for field, value in msg.match.items())
+            self.table.delete(fields, msg.cookie, msg.cookie_mask)
+
+    def handle_OFPGroupMod(self, msg):
+        ofp = self.ofproto
+        if msg.command in (ofp.OFPGC_ADD, ofp.OFPGC_MODIFY):
+            self.groups[msg.group_id] = msg
+        elif msg.command == ofp.OFPGC_DELETE:
+            if msg.group_id == ofp.OFPG_ALL:
+                self.groups.clear()
+            else:
+                self.groups.pop(msg.group_id, None)
+
+    def handle_OFPPacketOut(self, msg):
+        if msg.data is None:
+            return
+        self.execute(msg.actions, Packet.parse(msg.data), msg.in_port)
+
+    def handle_OFPBarrierRequest(self, msg):
+        self.reply(self.ofproto_parser.OFPBarrierReply(self), msg)
+
+    def handle_OFPEchoRequest(self, msg):
+        self.reply(self.ofproto_parser.OFPEchoReply(self, data=msg.data), msg)
+
+    def handle_OFPFlowStatsRequest(self, msg):
+        parser = self.ofproto_parser
+        now = CLOCK()
+        fields = dict((field, normalize(field, value)) for field, value in msg.match.items())
+        body = []
+        for entry in self.table.entries(fields, msg.cookie, msg.cookie_mask):
+            duration = now - entry.install_time
+            body.append(parser.OFPFlowStats(table_id=0, duration_sec=int(duration),
+                                            duration_nsec=int(duration % 1 * 1e9), priority=entry.priority,
+                                            idle_timeout=0, hard_timeout=0, flags=0, cookie=entry.cookie,
+                                            packet_count=entry.packet_count, byte_count=entry.byte_count,
+                                            match=entry.match, instructions=entry.instructions))
+        parts = [body[i:i + MULTIPART_ENTRIES] for i in range(0, len(body), MULTIPART_ENTRIES)] or [[]]
+        for i, part in enumerate(parts):
+            reply = parser.OFPFlowStatsReply(self, type_=self.ofproto.OFPMP_FLOW)
+            reply.body = part
+            reply.flags = self.ofproto.OFPMPF_REPLY_MORE if i < len(parts) - 1 else 0
+            self.reply(reply, msg)
+
+    def handle_OFPPortStatsRequest(self, msg):
+        parser = self.ofproto_parser
+        now = CLOCK()
+        body = []
+        for port in self.ports.values():
+            if msg.port_no not in (self.ofproto.OFPP_ANY, port.port_no):
+                continue
+            duration = now - port.start_time
+            body.append(parser.OFPPortStats(port_no=port.port_no, rx_packets=port.rx_packets,
+                                            tx_packets=port.tx_packets, rx_bytes=port.rx_bytes,
+                                            tx_bytes=port.tx_bytes, rx_dropped=port.rx_dropped,
+                                            tx_dropped=port.tx_dropped, rx_errors=0, tx_errors=0,
+                                            rx_frame_err=0, rx_over_err=0, rx_crc_err=0, collisions=0,
+                                            duration_sec=int(duration), duration_nsec=int(duration % 1 * 1e9)))
+        reply = parser.OFPPortStatsReply(self, type_=self.ofproto.OFPMP_PORT_STATS)
+        reply.body = body
+        reply.flags = 0
+        self.reply(reply, msg)
+
+    def handle_OFPAggregateStatsRequest(self, msg):
+        parser = self.ofproto_parser
+        fields = dict((field, normalize(field, value)) for field, value in msg.match.items())
+        entries = list(self.table.entries(fields, msg.cookie, msg.cookie_mask))
+        reply = parser.OFPAggregateStatsReply(self, type_=self.ofproto.OFPMP_AGGREGATE)
+        reply.body = parser.OFPAggregateStats(packet_count=sum(entry.packet_count for entry in entries),
+                                              byte_count=sum(entry.byte_count for entry in entries),
+                                              flow_count=len(entries))
+        reply.flags = 0
+        self.reply(reply, msg)
+
+    # A batch of packets arrives at a port
+    def receive(self, packet, in_port):
+        port = self.ports.get(in_port)
+        if port is None or not self.is_active:
+            return
+        port.rx_packets += packet.count
+        port.rx_bytes += packet.count * packet.size
+        entry = self.table.lookup(packet.fields)
+        if entry is None:
+            self.table_misses += packet.count
+            return
+        entry.packet_count += packet.count
+        entry.byte_count += packet.count * packet.size
+        self.execute(entry.actions, packet, in_port, entry.cookie)
+
+    # Apply an action list to a batch of packets
+    def execute(self, actions, packet, in_port, cookie=0):
+        parser = self.ofproto_parser
+        packet = packet.copy()
+        for action in actions:
+            if isinstance(action, parser.OFPActionOutput):
+                self.output(action.port, packet.copy(), in_port, cookie)
+            elif isinstance(action, parser.OFPActionGroup):
+                self.group(action.group_id, packet, in_port, cookie)
+            elif isinstance(action, parser.OFPActionPushVlan):
+                packet.fields['vlan_vid'] = self.ofproto.OFPVID_PRESENT
+            elif isinstance(action, parser.OFPActionPopVlan):
+                packet.fields.pop('vlan_vid', None)
+            elif isinstance(action, parser.OFPActionSetField):
+                packet.fields[action.key] = normalize(action.key, action.value)
+
+    # Select groups send a batch to one bucket chosen by weight from a hash of its flow fields,
+    # so every packet of a flow takes the same bucket as with OVS. Fast failover groups use
+    # their first bucket watching a live port, all groups use every bucket
+    def group(self, group_id, packet, in_port, cookie):
+        ofp = self.ofproto
+        mod = self.groups.get(group_id)
+        if mod is None:
+            return
+        if mod.type == ofp.OFPGT_SELECT:
+            buckets = [bucket for bucket in mod.buckets if bucket.weight > 0]
+            if not buckets:
+                return
+            bounds = np.cumsum([bucket.weight for bucket in buckets])
+            flow = repr([packet.fields.get(field) for field in FLOW_HASH_FIELDS]).encode()
+            bucket = buckets[int(np.searchsorted(bounds, zlib.crc32(flow) % bounds[-1], side='right'))]
+            self.execute(bucket.actions, packet, in_port, cookie)
+        elif mod.type == ofp.OFPGT_FF:
+            for bucket in mod.buckets:
+                port = self.ports.get(bucket.watch_port)
+                if port is not None and port.live():
+                    self.execute(bucket.actions, packet, in_port, cookie)
+                    return
+        else:
+            for bucket in mod.buckets:
+                self.execute(bucket.actions, packet, in_port, cookie)
+                if mod.type == ofp.OFPGT_INDIRECT:
+                    return
+
+    def output(self, port_no, packet, in_port, cookie):
+        ofp = self.ofproto
+        if port_no == ofp.OFPP_CONTROLLER:
+            data = packet.frame()
+            self.reply(self.ofproto_parser.OFPPacketIn(self, buffer_id=ofp.OFP_NO_BUFFER, total_len=len(data),
+                                                       reason=ofp.OFPR_ACTION, table_id=0, cookie=cookie,
+                                                       match=self.ofproto_parser.OFPMatch(in_port=in_port),
+                                                       data=data))
+            return
+        if port_no == ofp.OFPP_IN_PORT:
+            port_no = in_port
+        port = self.ports.get(port_no)
+        if port is None:
+            return
+        if not port.live():
+            port.tx_dropped += packet.count
+            return
+        port.tx_packets += packet.count
+        port.tx_bytes += packet.count * packet.size
+        if port.link is None:
+            self.network.delivered[self.id] += packet.count
+            return
+        self.network.transmit(self, port.link, packet)
+
+# Emulated network: switches, links, hosted apps and traffic
+class Network(object):
+    def __init__(self, control_delay=CONTROL_DELAY, seed=None):
+        self.control_delay = control_delay
+        self.switches = {} # self.switches[dpid] = Datapath
+        self.links = {} # self.links[(s1, s2)] = EmulatedLink between s1 and s2 (both orders)
+        self.apps = []
+        self.events = hub.Queue() # events for the apps, in the order they happened
+        self.random = np.random.RandomState(seed)
+        self.delivered = Counter() # packets delivered to the host of each switch
+        self.lost = 0 # packets lost on the links
+        self.event_thread = hub.spawn(self.dispatch)
+
+    def schedule(self, delay, func, *args):
+        eventlet.hubs.get_hub().schedule_call_global(delay, func, *args)
+
+    def add_switch(self, dpid):
+        self.switches[dpid] = Datapath(self, dpid, self.control_delay)
+        return self.switches[dpid]
+
+    # Link two switches through their next free ports
+    def add_link(self, s1, s2, delay=LINK_DELAY, loss=LINK_LOSS):
+        for dpid in (s1, s2):
+            if dpid not in self.switches:
+                self.add_switch(dpid)
+        p1 = max(self.switches[s1].ports) + 1
+        p2 = max(self.switches[s2].ports) + 1
+        link = EmulatedLink(s1, p1, s2, p2, delay, loss)
+        self.switches[s1].ports[p1] = PortState(p1, link, CLOCK())
+        self.switches[s2].ports[p2] = PortState(p2, link, CLOCK())
+        self.links[(s1, s2)] = self.links[(s2, s1)] = link
+        return link
+
+    # Change a link like tc qdisc change ... netem does, delay in seconds
+    def set_link(self, s1, s2, delay=None, loss=None):
+        link = self.links[(s1, s2)]
+        if delay is not None:
+            link.delay = delay
+        if loss is not None:
+            link.loss = loss
+
+    # Take a link down (or up): its ports stop forwarding at once and the apps
+    # are told of the link deletion (addition) as the topology discovery would
+    def set_link_up(self, s1, s2, up):
+        link = self.links[(s1, s2)]
+        if link.up == up:
+            return
+        link.up = up
+        ev_cls = event.EventLinkAdd if up else event.EventLinkDelete
+        delay = DISCOVERY_DELAY if up else PORT_STATUS_DELAY
+        a, b = link.ends
+        self.schedule(delay, self.send_event, ev_cls(Link(a, b)), MAIN_DISPATCHER)
+        self.schedule(delay, self.send_event, ev_cls(Link(b, a)), MAIN_DISPATCHER)
+
+    # Disconnect a switch from the controller, its links go down with it
+    def remove_switch(self, dpid):
+        dp = self.switches[dpid]
+        for port in dp.ports.values():
+            if port.link is not None:
+                a, b = port.link.ends
+                self.set_link_up(a.dpid, b.dpid, False)
+        dp.is_active = False
+        ev = ofp_event.EventOFPStateChange(dp)
+        ev.state = DEAD_DISPATCHER
+        self.schedule(self.control_delay, self.send_event, ev, DEAD_DISPATCHER)
+
+    # Send a batch of packets over a link, some of them being lost
+    def transmit(self, dp, link, packet):
+        packet.hops += 1
+        if packet.hops > MAX_HOPS:
+            return
+        count = self.random.binomial(packet.count, 1 - link.loss) if link.loss > 0 else packet.count
+        self.lost += packet.count - count
+        if count == 0:
+            return
+        self.schedule(link.delay, self.arrive, link, link.peer(dp.id), packet.copy(int(count)))
+
+    def arrive(self, link, end, packet):
+        if link.up: # else lost in flight when the link went down
+            self.switches[end.dpid].receive(packet, end.port_no)
+
+    # Start a ryu application class in this process, on the emulated switches
+    def add_app(self, app_cls):
+        app = app_cls()
+        register_instance(app)
+        if hasattr(app, 'routing_pool'):
+            app.routing_pool.shutdown(wait=False)
+            app.routing_pool = InlineExecutor()
+        app.start()
+        self.apps.append(app)
+        return app
+
+    def send_event(self, ev, state):
+        self.events.put((ev, state))
+
+    # Hand the events to the apps from a green thread, as their queues may be full
+    def dispatch(self):
+        while True:
+            ev, state = self.events.get()
+            for app in self.apps:
+                app._send_event(ev, state)
+
+    # OpenFlow message from a switch to the controller
+    def deliver(self, msg):
+        if msg.datapath.is_active:
+            self.send_event(ofp_event.ofp_msg_to_ev(msg), MAIN_DISPATCHER)
+
+    # Connect every switch, then report every link in both directions
+    def start(self):
+        for dp in self.switches.values():
+            ev = ofp_event.EventOFPStateChange(dp)
+            ev.state = MAIN_DISPATCHER
+            self.send_event(ev, MAIN_DISPATCHER)
+        reported = set()
+        for link in self.links.values():
+            if id(link) in reported:
+                continue
+            reported.add(id(link))
+            a, b = link.ends
+            self.schedule(DISCOVERY_DELAY, self.send_event, event.EventLinkAdd(Link(a, b)), MAIN_DISPATCHER)
+            self.schedule(DISCOVERY_DELAY, self.send_event, event.EventLinkAdd(Link(b, a)), MAIN_DISPATCHER)
+
+    # Constant rate traffic (packets per second) from the host of switch src to the host of
+    # switch dst (or between the given addresses), injected in one batch every tick seconds
+    def add_traffic(self, src, dst, rate, size=1000, tick=0.1, ipv4_src=None, ipv4_dst=None):
+        fields = {'eth_type': 0x0800,
+                  'ipv4_src': ipv4_src or host_ip(src),
+                  'ipv4_dst': ipv4_dst or host_ip(dst)}
+        return hub.spawn(self.traffic_loop, src, fields, rate, size, tick)
+
+    def traffic_loop(self, src, fields, rate, size, tick):
+        carry = 0.0
+        while True:
+            carry += rate * tick
+            count = int(carry)
+            carry -= count
+            if count:
+                self.switches[src].receive(Packet(dict(fields), count, size), HOST_PORT)
+            hub.sleep(tick)
+
+    # Messages handled by the switches, by type
+    def received(self):
+        total = Counter()
+        for dp in self.switches.values():
+            total.update(dp.received)
+        return total
+
+    def report(self):
+        received = self.received()
+        return {
+            'switches': len(self.switches),
+            'links': len(self.links) // 2,
+            'virtual_time': CLOCK(),
+            'messages': dict(received),
+            'flow_entries': sum(len(dp.table) for dp in self.switches.values()),
+            'groups': sum(len(dp.groups) for dp in self.switches.values()),
+            'delivered': sum(self.delivered.values()),
+            'lost': self.lost,
+            'table_misses': sum(dp.table_misses for dp in self.switches.values()),
+        }
+
+# Connected random topology of n switches with an average degree of about degree:
+# a random tree plus random extra links
+def random_topology(n, degree=3, seed=None):
+    rng = np.random.RandomState(seed)
+    links = set()
+    for i in range(2, n + 1):
+        links.add((int(rng.randint(1, i)), i))
+    extra = max(0, int(n * degree / 2) - len(links))
+    while extra > 0 and len(links) < n * (n - 1) // 2:
+        s1, s2 = sorted(int(x) for x in rng.randint(1, n + 1, size=2))
+        if s1 != s2 and (s1, s2) not in links:
+            links.add((s1, s2))
+            extra -= 1
+    return sorted(links)
+
+# RyuApp classes defined by an app module, as ryu-manager loads them
+def load_apps(name):
+    module = importlib.import_module(name)
+    return [cls for _, cls in inspect.getmembers(module, inspect.isclass)
+            if issubclass(cls, app_manager.RyuApp) and cls.__module__ == module.__name__]
+
+# Link S1-S2 of the network given on the command line
+def parse_link(network, text):
+    s1, s2 = (int(dpid) for dpid in text.split('-'))
+    if (s1, s2) not in network.links:
+        raise ValueError('no link between switches %d and %d' % (s1, s2))
+    return s1, s2
+
+# Scheduled topology changes: TIME:down:S1-S2, TIME:up:S1-S2, TIME:netem:S1-S2:DELAY_MS:LOSS
+# or TIME:disconnect:DPID
+def schedule_event(network, spec):
+    parts = spec.split(':')
+    at, action = float(parts[0]), parts[1]
+    if action in ('down', 'up'):
+        s1, s2 = parse_link(network, parts[2])
+        network.schedule(at, network.set_link_up, s1, s2, action == 'up')
+    elif action == 'netem':
+        s1, s2 = parse_link(network, parts[2])
+        network.schedule(at, network.set_link, s1, s2, float(parts[3]) / 1000, float(parts[4]))
+    elif action == 'disconnect':
+        network.schedule(at, network.remove_switch, int(parts[2]))
+    else:
+        raise ValueError('unknown event: ' + spec)
+
+# Log the message rates of every interval of virtual time
+def monitor(network, interval):
+    last = Counter()
+    last_real = time.perf_counter()
+    while True:
+        hub.sleep(interval)
+        received = network.received()
+        now_real = time.perf_counter()
+        flow_mods = received['OFPFlowMod'] - last['OFPFlowMod']
+        logging.info('t=%.1fs: %d flow mods (%.0f/s virtual, %.0f/s real), %d messages, %d flow entries',
+                     CLOCK(), flow_mods, flow_mods / interval, flow_mods / max(now_real - last_real, 1e-9),
+                     sum(received.values()) - sum(last.values()),
+                     sum(len(dp.table) for dp in network.switches.values()))
+        last, last_real = received, now_real
+
+def main():
+    parser = argparse.ArgumentParser(description='Run ryu applications on an emulated OpenFlow network')
+    parser.add_argument('--topology', choices=sorted(TOPOLOGIES) + ['random'], default='bso')
+    parser.add_argument('--switches', type=int, default=1000, help='switches of the random topology')
+    parser.add_argument('--degree', type=float, default=3, help='average degree of the random topology')
+    parser.add_argument('--apps', nargs='+', default=['routing', 'enode_select'], help='app modules to run')
+    parser.add_argument('--apps-dir', default=APPS_DIR)
+    parser.add_argument('--set', nargs='*', default=[], metavar='MODULE.NAME=VALUE',
+                        help='override a constant of an app module')
+    parser.add_argument('--duration', type=float, default=60, help='virtual seconds to run')
+    parser.add_argument('--delay', type=float, default=LINK_DELAY * 1000, help='link delay (ms)')
+    parser.add_argument('--loss', type=float, default=LINK_LOSS, help='link loss rate')
+    parser.add_argument('--control-delay', type=float, default=CONTROL_DELAY * 1000,
+                        help='one way controller-switch delay (ms)')
+    parser.add_argument('--link', nargs='*', default=[], metavar='S1-S2:DELAY_MS:LOSS',
+                        help='delay and loss of a link')
+    parser.add_argument('--traffic', nargs='*', default=[], metavar='SRC-DST:RATE',
+                        help='host to host traffic, in packets per second')
+    parser.add_argument('--outbound', type=float, default=0,
+                        help='outbound traffic rate of enode_select (packets per second)')
+    parser.add_argument('--event', nargs='*', default=[], metavar='TIME:ACTION:ARGS',
+                        help='down:S1-S2, up:S1-S2, netem:S1-S2:DELAY_MS:LOSS or disconnect:DPID')
+    parser.add_argument('--report-interval', type=float, default=10)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s: %(message)s')
+    eventlet.hubs.use_hub(VirtualHub)
+    CLOCK.install()
+
+    sys.path.insert(0, os.path.abspath(args.apps_dir))
+    app_classes = []
+    for name in args.apps:
+        app_classes.extend(load_apps(name))
+    for assignment in args.set:
+        target, value = assignment.split('=', 1)
+        module, constant = target.rsplit('.', 1)
+        setattr(importlib.import_module(module), constant, ast.literal_eval(value))
+
+    network = Network(args.control_delay / 1000, args.seed)
+    if args.topology == 'random':
+        links = random_topology(args.switches, args.degree, args.seed)
+    else:
+        links = TOPOLOGIES[args.topology]
+    for s1, s2 in links:
+        network.add_link(s1, s2, args.delay / 1000, args.loss)
+    for spec in args.link:
+        pair, delay, loss = spec.split(':')
+        network.set_link(*parse_link(network, pair), delay=float(delay) / 1000, loss=float(loss))
+    for spec in args.traffic:
+        pair, rate = spec.split(':')
+        src, dst = (int(dpid) for dpid in pair.split('-'))
+        if src not in network.switches or dst not in network.switches:
+            raise ValueError('no switch ' + str(src if src not in network.switches else dst))
+        network.add_traffic(src, dst, float(rate))
+    if args.outbound:
+        enode_select = importlib.import_module('enode_select')
+        for ingress, ipv4_src in enode_select.INGRESS_SRC_IPS.items():
+            network.add_traffic(ingress, None, args.outbound, ipv4_src=ipv4_src,
+                                ipv4_dst=enode_select.OUTBOUND_DST_IP)
+    for spec in args.event:
+        schedule_event(network, spec)
+
+    for cls in app_classes:
+        network.add_app(cls)
+    network.start()
+    hub.spawn(monitor, network, args.report_interval)
+
+    start = time.perf_counter()
+    hub.sleep(args.duration)
+    elapsed = time.perf_counter() - start
+
+    report = network.report()
+    for key, value in sorted(report.items()):
+        logging.info('%s: %s', key, value)
+    flow_mods = report['messages'].get('OFPFlowMod', 0)
+    logging.info('%.1f virtual seconds in %.1f real seconds, %.0f flow mods/s (real)',
+                 report['virtual_time'], elapsed, flow_mods / max(elapsed, 1e-9))
+    CLOCK.uninstall()
+
+if __name__ == '__main__':
+    main()